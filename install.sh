@@ -6,7 +6,9 @@ PYTHONDIR="$PWD/.sputnik-env"
 
 install_packages()
 {
-    PKGLIST="virtualenv python3 ffmpeg tesseract-ocr"
+    # libtesseract-dev, libleptonica-dev and pkg-config are for building tesserocr, which lets the OCR
+    # workers keep Tesseract loaded instead of starting it up for every image
+    PKGLIST="virtualenv python3 python3-dev build-essential pkg-config ffmpeg tesseract-ocr tesseract-ocr-spa tesseract-ocr-fra tesseract-ocr-fin libtesseract-dev libleptonica-dev"
     sudo apt update
 
     sudo apt install -y ${PKGLIST}
@@ -0,0 +1,77 @@
+import io
+import time
+import logging
+
+from urllib.parse import urlsplit, parse_qs
+
+import discord
+
+log = logging.getLogger(__name__)
+
+# How long to keep using a CDN link that doesn't say when it expires
+DEFAULT_TTL = 12*60*60
+# Stop using links this long before they expire, so they don't run out while someone's looking at them
+EXPIRY_MARGIN = 60*60
+
+def expiry(url):
+    """
+    When a Discord CDN link stops working, from its ex parameter (a hex timestamp), if it has one.
+    """
+    try:
+        return int(parse_qs(urlsplit(url).query)["ex"][0], 16)
+    except (KeyError, ValueError):
+        return None
+
+class Asset:
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.data = data
+        self.url = None
+        self.expires = 0
+
+class AssetRegistry:
+    """
+    Images the bot sends over and over. Each one's read from disk once, uploaded the first time it's
+    needed, and after that linked to by its CDN URL instead of being uploaded again, until the link expires.
+    """
+    def __init__(self, paths):
+        self.assets = {}
+        for name, path in paths.items():
+            try:
+                with open(path, 'rb') as f:
+                    self.assets[name] = Asset(path.rsplit("/", 1)[-1], f.read())
+            except OSError:
+                log.exception("Unable to load asset %s from %s", name, path)
+
+    def attach(self, name, embed):
+        """
+        Puts the asset in embed as its image. Returns the files that need to go with it, which are None
+        if there's still a working link to it.
+        """
+        asset = self.assets.get(name)
+        if asset is None:
+            return None
+
+        if asset.url and time.time() < asset.expires - EXPIRY_MARGIN:
+            embed.set_image(url=asset.url)
+            return None
+
+        embed.set_image(url="attachment://" + asset.filename)
+        return [discord.File(io.BytesIO(asset.data), filename=asset.filename)]
+
+    def sent(self, name, message):
+        """
+        Picks the CDN URL for the asset out of a message it was uploaded in.
+        """
+        asset = self.assets.get(name)
+        url = None
+        if message.embeds and message.embeds[0].image:
+            url = message.embeds[0].image.url
+        if not url and message.attachments:
+            url = message.attachments[0].url
+        if asset is None or not url or url.startswith("attachment://"):
+            return
+
+        asset.url = url
+        asset.expires = expiry(url) or time.time() + DEFAULT_TTL
+        log.info("Uploaded %s, reusing %s until %s", name, url, time.strftime("%Y-%m-%d %H:%M", time.localtime(asset.expires - EXPIRY_MARGIN)))
@@ -0,0 +1,363 @@
+#!/usr/bin/python3
+"""
+Microbenchmarks for Sputnik's pure-Python hot paths.
+
+Results are saved as JSON under bench/, named after the current commit, and compared against
+an earlier run to flag anything that's gotten slower.
+
+Usage:
+    python src/benchmarks.py [--filter TEXT] [--baseline FILE] [--threshold FRACTION] [--no-save]
+"""
+import io
+import os
+import ast
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import importlib.util
+
+from timeit import Timer
+from types import SimpleNamespace
+from contextlib import redirect_stdout
+
+BENCH_DIR = "bench/"
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+##################################################################
+# Registering
+##################################################################
+
+benchmarks = []
+
+def benchmark(name, requires=()):
+    """
+    Registers a benchmark. The decorated function does any setup, and returns the callable to be timed.
+    requires names the modules of ours that it imports; it's skipped if anything they import isn't installed.
+    """
+    def register(setup):
+        benchmarks.append((name, setup, requires))
+        return setup
+    return register
+
+def dependencies(modules):
+    """
+    The third party modules that importing the given modules of ours pulls in, following their imports
+    through any other modules of ours. Only imports made at the top of a module count; ones inside
+    functions, or in try blocks for optional modules, aren't needed just to import it.
+    """
+    seen = set()
+    needed = set()
+    todo = list(modules)
+    while todo:
+        name = todo.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        path = os.path.join(SRC_DIR, name + ".py")
+        if not os.path.isfile(path):
+            if name not in sys.stdlib_module_names:
+                needed.add(name)
+            continue
+
+        with open(path) as f:
+            tree = ast.parse(f.read())
+        for node in tree.body:
+            if isinstance(node, ast.Import):
+                todo.extend(alias.name.split(".")[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                todo.append(node.module.split(".")[0])
+    return sorted(needed)
+
+##################################################################
+# Dice
+##################################################################
+
+def roll(expression):
+    import dice
+    def run():
+        rolls = dice.DiceSet()
+        rolls.parseString(expression)
+        rolls.result()
+    return run
+
+@benchmark("dice.small", requires=("dice",))
+def bench_dice_small():
+    return roll("4d6dl1+2 strength")
+
+@benchmark("dice.mixed_operators", requires=("dice",))
+def bench_dice_mixed():
+    return roll("2d20dh1+1d4*2-1d6+3 attack")
+
+@benchmark("dice.long_list", requires=("dice",))
+def bench_dice_long_list():
+    return roll(", ".join(["1d20+5"]*200))
+
+@benchmark("dice.long_chain", requires=("dice",))
+def bench_dice_long_chain():
+    return roll("+".join(["1d6"]*500))
+
+@benchmark("dice.many_dice_with_drops", requires=("dice",))
+def bench_dice_many_dice():
+    return roll("2000d6dl500dh500")
+
+##################################################################
+# Config
+##################################################################
+
+def fake_guilds(count):
+    return [SimpleNamespace(id=10**17+i, name="guild-%d" % i) for i in range(count)]
+
+def config_with_guilds(count):
+    """
+    Builds a config directory in a temporary folder with a server file for each of count guilds.
+    """
+    from config import Config, SERVER_DIR
+
+    directory = tempfile.mkdtemp(prefix="sputnik-bench-")
+    shutil.copytree("config", directory, dirs_exist_ok=True)
+    guilds = fake_guilds(count)
+    for guild in guilds:
+        with open(os.path.join(directory, SERVER_DIR, "%d.ini" % guild.id), 'w') as f:
+            f.write("[Server]\nCommandPrefix = ?\nDefaultVolume = 0.2\n")
+    return Config(config_dir=directory + "/"), guilds, directory
+
+@benchmark("config.server_setup_2000", requires=("config",))
+def bench_server_setup():
+    config, guilds, directory = config_with_guilds(2000)
+    def run():
+        with redirect_stdout(io.StringIO()):
+            config.server_setup(guilds)
+    run.cleanup = lambda: shutil.rmtree(directory)
+    return run
+
+@benchmark("config.get_2000", requires=("config",))
+def bench_config_get():
+    config, guilds, directory = config_with_guilds(2000)
+    with redirect_stdout(io.StringIO()):
+        config.server_setup(guilds)
+    rng = random.Random(0)
+    lookups = [(rng.choice(guilds).id, key) for key in ("CommandPrefix", "BindToChannels", "DefaultVolume", "NowPlayingMentions") for i in range(250)]
+    def run():
+        for guild, key in lookups:
+            config.get(guild, "Server", key)
+    run.cleanup = lambda: shutil.rmtree(directory)
+    return run
+
+##################################################################
+# Bot
+##################################################################
+
+def sim_bot(guild_count=20):
+    import loadsim
+
+    loop = asyncio.new_event_loop()
+    http = loadsim.FakeHTTP(latency=0)
+    guilds = [loadsim.FakeGuild(http, "guild-%d" % i) for i in range(guild_count)]
+    with redirect_stdout(io.StringIO()):
+        sim = loadsim.make_bot(http, guilds)
+
+    # Sets the client up on this loop, as entering it with async with would
+    loop.run_until_complete(sim.__aenter__())
+    return sim, guilds, loop, loadsim
+
+@benchmark("bot.on_message_lookup", requires=("loadsim", "bot"))
+def bench_on_message():
+    sim, guilds, loop, loadsim = sim_bot()
+    rng = random.Random(0)
+    # Everything that on_message has to look at, without going on to run a command
+    messages = [
+        loadsim.FakeMessage(rng.choice(guild.text_channels), rng.choice(guild.members), text)
+        for guild in guilds
+        for text in ("just chatting about things", "!notacommand", "!alsonotacommand with arguments")
+    ]
+
+    async def dispatch():
+        for message in messages:
+            await sim.on_message(message)
+
+    def run():
+        loop.run_until_complete(dispatch())
+    run.cleanup = loop.close
+    return run
+
+def long_queue(length):
+    import player
+
+    guild = SimpleNamespace(id=1, name="guild", voice_client=SimpleNamespace(
+        is_playing=lambda: True, is_paused=lambda: False, stop=lambda: None,
+        channel=SimpleNamespace(members=[object()]*8)
+    ))
+    config = SimpleNamespace(get=lambda server, section, key: {"DefaultVolume": "0.15", "SkipsRequired": "4", "SkipRatio": "0.5", "CommandPrefix": "!"}.get(key))
+    bot = SimpleNamespace(config=config, loop=None)
+    queue = player.Player(bot, guild)
+    author = SimpleNamespace(display_name="someone", mention="<@1>")
+    songs = [
+        {"title": "Song %d" % i, "duration": 200+i, "webpage_url": "https://example.com/%d" % i, "message": SimpleNamespace(author=author, guild=guild)}
+        for i in range(length)
+    ]
+    return queue, songs, author
+
+@benchmark("player.add_1000", requires=("player",))
+def bench_player_add():
+    import logging
+    queue, songs, author = long_queue(1000)
+    logging.getLogger("player").disabled = True
+    def run():
+        queue.playlist = list()
+        for song in songs:
+            queue.add(song)
+    return run
+
+@benchmark("player.skip_front_1000", requires=("player",))
+def bench_player_skip():
+    import logging
+    queue, songs, author = long_queue(1000)
+    logging.getLogger("player").disabled = True
+    def run():
+        queue.playlist = [dict(song) for song in songs]
+        while queue.playlist:
+            queue.skip(author, index=0)
+    return run
+
+@benchmark("player.shuffle_5000", requires=("player",))
+def bench_player_shuffle():
+    queue, songs, author = long_queue(5000)
+    queue.playlist = list(songs)
+    return queue.shuffle
+
+@benchmark("commands.queue_embed_25", requires=("commands", "player"))
+def bench_queue_embed():
+    import commands
+
+    queue, songs, author = long_queue(25)
+    queue.playlist = list(songs)
+    bot = SimpleNamespace(players={1: queue}, config=queue.bot.config, loop=asyncio.new_event_loop())
+    message = SimpleNamespace(guild=queue.guild, author=author)
+
+    def run():
+        bot.loop.run_until_complete(commands.cmd_queue(bot, message))
+    run.cleanup = bot.loop.close
+    return run
+
+##################################################################
+# Running and comparing
+##################################################################
+
+def measure(func, repeat=5):
+    """
+    Times func, calibrated to run for at least 0.2s per repeat. Returns seconds per call for each repeat.
+    """
+    timer = Timer(func)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * 0.2 / max(elapsed, 1e-9)))
+    return [elapsed/number for elapsed in timer.repeat(repeat=repeat, number=number)]
+
+def run(filter=None):
+    results = {}
+    for name, setup, requires in benchmarks:
+        if filter and filter not in name:
+            continue
+        missing = [module for module in dependencies(requires) if importlib.util.find_spec(module) is None]
+        if missing:
+            print("%-32s skipped, missing %s" % (name, ", ".join(missing)))
+            continue
+
+        func = setup()
+        try:
+            times = sorted(measure(func))
+        finally:
+            if hasattr(func, "cleanup"):
+                func.cleanup()
+        results[name] = {"median": times[len(times)//2], "min": times[0], "max": times[-1]}
+        print("%-32s %12s  (min %s)" % (name, duration(results[name]["median"]), duration(results[name]["min"])))
+    return results
+
+def duration(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return "%.2f%s" % (seconds/scale, unit)
+    return "%.0fns" % (seconds/1e-9)
+
+def git(*args):
+    try:
+        return subprocess.run(["git"] + list(args), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+    except OSError:
+        return ""
+
+def save(results):
+    commit = git("rev-parse", "--short", "HEAD") or "unknown"
+    dirty = bool(git("status", "--porcelain", "--untracked-files=no"))
+    name = commit + ("-dirty" if dirty else "")
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    path = os.path.join(BENCH_DIR, name + ".json")
+    with open(path, 'w') as f:
+        json.dump({
+            "commit": commit,
+            "dirty": dirty,
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.node(),
+            "results": results,
+        }, f, indent=2)
+    return path
+
+def latest_baseline():
+    """
+    The most recently saved run.
+    """
+    if not os.path.isdir(BENCH_DIR):
+        return None
+    runs = [os.path.join(BENCH_DIR, name) for name in os.listdir(BENCH_DIR) if name.endswith(".json")]
+    return max(runs, key=os.path.getmtime) if runs else None
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change in each benchmark against the baseline, and returns the names of any that regressed
+    by more than threshold (as a fraction of the baseline's median).
+    """
+    print("\nCompared to %s from %s:" % (baseline.get("commit"), baseline.get("date")))
+    regressions = []
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if not before:
+            continue
+        change = result["median"]/before["median"] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print("%-32s %+7.1f%%%s" % (name, change*100, flag))
+    return regressions
+
+if __name__ == "__main__":
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__))+"/..")
+
+    parser = argparse.ArgumentParser(description="Microbenchmarks for Sputnik's hot paths")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--baseline", help="results file to compare against; defaults to the most recent saved run")
+    parser.add_argument("--threshold", type=float, default=0.10, help="slowdown, as a fraction, that counts as a regression")
+    parser.add_argument("--no-save", action="store_true", help="don't save the results")
+    args = parser.parse_args()
+
+    # Read the baseline now, in case this run is about to overwrite it
+    baseline = None
+    baseline_path = args.baseline or latest_baseline()
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+    results = run(args.filter)
+
+    if not args.no_save:
+        print("\nSaved results to %s" % save(results))
+
+    if baseline and compare(results, baseline, args.threshold):
+        sys.exit(1)
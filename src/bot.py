@@ -1,10 +1,16 @@
 #!/usr/bin/python3
+import sys
+
+# Has to come before everything else, so that it can time their imports
+import startup
+startup.enable(__name__ == "__main__" and "--profile-startup" in sys.argv)
+
 import logging
 import asyncio
-import sys
 import re
 import io
 import os
+import time
 import importlib
 import traceback
 
@@ -12,16 +18,18 @@ from functools import wraps
 from textwrap import dedent
 from datetime import datetime
 
-import aiohttp
 import discord
-import colorlog
-import yt_dlp
-
-import pytesseract
-from PIL import Image
 
 from config import Config
-from suggestions import SuggestionList
+import logfile
+import metrics
+import loopwatch
+import fetch
+import recent
+import dice
+from assets import AssetRegistry
+import ocr
+from permissions import PermissionResolver
 import commands
 import player
 
@@ -45,8 +53,51 @@ class Bot(discord.Client):
         self.config = config
         self.players={}
         self.message_pipes={}
-
-        self.ytdl = yt_dlp.YoutubeDL(player.ydl_opts)
+        self.metrics_server = None
+        self._ytdl = None
+        self._ocr_cache = False
+        self._suggestions = False
+        self.watchdog = None
+        self.running_commands = {}
+        self.assets = AssetRegistry({"hug": "virtual_hug.gif", "guillotine": "guillotine.gif"})
+        self.recent = recent.RecentMessages(
+            per_channel=int(self.config.get(0, "RecentMessages", "PerChannel") or 50),
+            channels=int(self.config.get(0, "RecentMessages", "Channels") or 1000)
+        )
+        self.permissions = PermissionResolver(self, ttl=int(self.config.get(0, "Permissions", "TTL") or 300))
+
+        self.executor = metrics.CountingExecutor(thread_name_prefix="sputnik")
+        self.fetcher = fetch.Fetcher(
+            max_bytes=int(self.config.get(0, "Fetch", "MaxBytes") or 25*1024*1024),
+            timeout=int(self.config.get(0, "Fetch", "Timeout") or 30),
+            connect_timeout=int(self.config.get(0, "Fetch", "ConnectTimeout") or 10),
+            connections=int(self.config.get(0, "Fetch", "Connections") or 20),
+            spool_bytes=int(self.config.get(0, "Fetch", "SpoolBytes") or 1024*1024)
+        )
+        self.upload_budget = fetch.ByteBudget(int(self.config.get(0, "Fetch", "MaxBytesPerGuild") or 100*1024*1024))
+        self.dice_budget = dice.Budget(
+            int(self.config.get(0, "Dice", "BudgetPerGuild") or 20000000),
+            int(self.config.get(0, "Dice", "BudgetRefill") or 200000)
+        )
+        self.ocr = ocr.OcrScheduler(
+            workers=int(self.config.get(0, "OCR", "Workers") or 2),
+            max_queued=int(self.config.get(0, "OCR", "MaxQueued") or 20),
+            timeout=int(self.config.get(0, "OCR", "Timeout") or 60),
+            lang=self.config.get(0, "OCR", "Languages") or "eng",
+            max_jobs=int(self.config.get(0, "OCR", "MaxJobsPerWorker") or 200),
+            health_interval=int(self.config.get(0, "OCR", "HealthCheckInterval") or 60),
+            tile_height=int(self.config.get(0, "OCR", "TileHeight") or 0) or None,
+            options={
+                "max_side": int(self.config.get(0, "OCR", "MaxSide") or 2000),
+                "binarize": self.config.get(0, "OCR", "Binarize") is not False,
+                "deskew": self.config.get(0, "OCR", "Deskew") is not False,
+                "detect_language": self.config.get(0, "OCR", "DetectLanguage") is not False,
+            }
+        )
+
+        metrics.EXECUTOR_QUEUE.callback = lambda: {("default",): self.executor.waiting, ("ocr",): self.ocr.queued()}
+        metrics.VOICE_SESSIONS.callback = lambda: {(): len(self.voice_clients)}
+        metrics.QUEUED_SONGS.callback = lambda: {(): sum(len(p.playlist) for p in list(self.players.values()))}
 
         if test: log.warning("Loading in TEST MODE")
 
@@ -54,21 +105,93 @@ class Bot(discord.Client):
 
         log.info("Initialized Client")
 
+    @property
+    def ytdl(self):
+        # yt_dlp is slow to import, and only needed once someone wants music
+        if self._ytdl is None:
+            import yt_dlp
+            self._ytdl = yt_dlp.YoutubeDL(player.ydl_opts)
+        return self._ytdl
+
+    @property
+    def ocr_cache(self):
+        if self._ocr_cache is False:
+            entries = int(self.config.get(0, "OCR", "CacheEntries") or 0)
+            self._ocr_cache = None
+            if entries:
+                try:
+                    from ocrcache import OcrCache
+                    self._ocr_cache = OcrCache(max_entries=entries, perceptual=self.config.get(0, "OCR", "PerceptualHash") is not False)
+                except Exception:
+                    log.exception("Unable to open the OCR cache. Images will be read from scratch every time.")
+        return self._ocr_cache
+
+    @property
+    def suggestions(self):
+        # Start following the Trello board the first time someone asks about suggestions, rather than on every startup
+        if self._suggestions is False:
+            try:
+                from suggestions import SuggestionList
+                self._suggestions = SuggestionList.connect(
+                    self.config.get(0, "Trello", "APIKey"), 
+                    self.config.get(0, "Trello", "APIToken"), 
+                    self.config.get(0, "Trello", "NewSuggestionList"),
+                    refresh_interval=int(self.config.get(0, "Trello", "RefreshInterval") or 300)
+                )
+                self._suggestions.start()
+            except:
+                log.error("Unable to connect to Trello. Suggestions unavailable.")
+                self._suggestions = None
+        return self._suggestions
+
+    @suggestions.setter
+    def suggestions(self, value):
+        self._suggestions = value
+
+    async def setup_hook(self):
+        self.loop.set_default_executor(self.executor)
+
+        self.watchdog = loopwatch.Watchdog(
+            self.loop,
+            interval=float(self.config.get(0, "Watchdog", "Interval") or 0.5),
+            threshold=float(self.config.get(0, "Watchdog", "StallThreshold") or 1.0),
+            describe=self.running_commands.get
+        )
+        self.watchdog.start()
+        self.permissions.start()
+        self.ocr.start()
+        await self.fetcher.start()
+
+        port = self.config.get(0, "Metrics", "Port")
+        if port and int(port):
+            self.metrics_server = metrics.MetricsServer(self.config.get(0, "Metrics", "Host") or "127.0.0.1", int(port))
+            try:
+                await self.metrics_server.start()
+            except OSError:
+                log.exception("Unable to start metrics server")
+                self.metrics_server = None
+
+    async def close(self):
+        self.permissions.stop()
+        if self._suggestions:
+            self._suggestions.stop()
+        if self.watchdog:
+            self.watchdog.stop()
+        self.ocr.stop()
+        if self._ocr_cache:
+            self._ocr_cache.close()
+        await self.fetcher.stop()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        await super().close()
+
     async def on_ready(self):
         log.info("Connected to Discord. Loading Server Information...")
-        try:
-            self.suggestions = SuggestionList(
-                self.config.get(0, "Trello", "APIKey"), 
-                self.config.get(0, "Trello", "APIToken"), 
-                None, 
-                None,
-                self.config.get(0, "Trello", "NewSuggestionList")
-            )
-        except:
-            log.error("Unable to connect to Trello. Suggestions unavailable.")
-            self.suggestions = None
-        self.config.server_setup(self.guilds)
-        self.validate_channels()
+        with startup.phase("Server setup"):
+            self.config.server_setup(self.guilds)
+            self.validate_channels()
+        startup.mark("Ready")
+        startup.write_report()
         
 
     def validate_channels(self):
@@ -94,6 +217,34 @@ class Bot(discord.Client):
         self.config.server_setup([guild,])
         self.players[guild.id] = player.Player(self, guild)
     
+    async def on_member_update(self, before, after):
+        if before.roles != after.roles:
+            self.permissions.invalidate_member(after.guild.id, after.id)
+
+    async def on_member_remove(self, member):
+        self.permissions.invalidate_member(member.guild.id, member.id)
+
+    async def on_guild_role_update(self, before, after):
+        self.permissions.invalidate_guild(after.guild.id)
+
+    async def on_guild_role_delete(self, role):
+        self.permissions.invalidate_guild(role.guild.id)
+
+    async def on_guild_update(self, before, after):
+        if before.owner_id != after.owner_id:
+            self.permissions.invalidate_guild(after.id)
+
+    async def on_message_edit(self, before, after):
+        self.recent.update(after)
+
+    async def on_raw_message_delete(self, payload):
+        self.recent.remove(payload.channel_id, {payload.message_id})
+        # Deleting a !read gives up on the image, wherever it's got to
+        self.ocr.cancel(payload.message_id)
+
+    async def on_raw_bulk_message_delete(self, payload):
+        self.recent.remove(payload.channel_id, payload.message_ids)
+
     async def on_error(self, event, *args, **kwargs):
         log.exception("Exception in bot handler")
 
@@ -117,6 +268,7 @@ class Bot(discord.Client):
 
     async def on_message(self, message):
         await self.wait_until_ready()
+        self.recent.add(message)
 
         if message.author == self.user:
             return
@@ -143,6 +295,9 @@ class Bot(discord.Client):
         self.loop.create_task(self.runCommand(command, handler, message))
         
     async def runCommand(self, command, handler, message):
+        start = time.perf_counter()
+        result = "error"
+        self.running_commands[asyncio.current_task()] = f"{message.content[:100]!r} on {message.guild if message.guild else ''}:{message.channel}"
         try:
             log.info(f"Running {command} on {message.guild if message.guild else ''}:{message.channel}")
             async with message.channel.typing():
@@ -151,8 +306,12 @@ class Bot(discord.Client):
             if not isinstance(replies, list):
                 replies = [replies,]
             for reply in replies:
-                await message.channel.send(content=reply.content, files=reply.files, embed=reply.embed)
+                sent = await message.channel.send(content=reply.content, files=reply.files, embed=reply.embed)
+                if reply.on_sent:
+                    reply.on_sent(sent)
+            result = "ok"
         except commands.IncorrectUsageError as e:
+            result = "usage"
             log.exception("Incorrect Usage of %s" % command)
             await message.channel.send(
                 content="Incorrect usage of %s:\n```%s```" % (
@@ -161,11 +320,16 @@ class Bot(discord.Client):
                     )
                 )
         except NotImplementedError as e:
+            result = "unimplemented"
             log.exception(f"Unimplemented command {command} used in {message.guild if message.guild else ''}:{message.channel}")
             await message.channel.send(content="I'm sorry, that command hasn't been written yet :sob:") 
         except Exception as e:
             log.exception(f"Exception on {command} in {message.guild if message.guild else ''}:{message.channel}")
             await message.channel.send(content="I'm sorry, something went wrong and I couldn't run that command properly. :sob:")
+        finally:
+            self.running_commands.pop(asyncio.current_task(), None)
+            metrics.COMMANDS.inc(command=command, result=result)
+            metrics.COMMAND_LATENCY.observe(time.perf_counter() - start, command=command)
 
     def reloadCommandSet(self):
         log.warning("Reloading command set...")
@@ -178,6 +342,7 @@ class Bot(discord.Client):
             await client.disconnect()
         command = "python" if " " in sys.executable else sys.executable
         log.error("{} - {}".format(sys.executable, [command] + sys.argv))
+        logfile.stop()
         os.execv(sys.executable, [command] + sys.argv)
 
     def attach_log_channel(self, channel):
@@ -209,26 +374,19 @@ class Bot(discord.Client):
             return False
 
 #   Set logging up across all modules
-def logging_setup(level="DEBUG"):
-
-    logging.basicConfig(level=level)
-
-    format = "%(asctime)s - %(levelname)s:%(name)s:%(message)s"
-
-    if os.path.isfile("logs/sputnik.log"):
-        try:
-            log.warning("Renaming old log file ")
-            if os.path.isfile("logs/sputnik_old.log"):
-                os.remove("logs/sputnik_old.log")
-            os.rename("logs/sputnik.log", "logs/sputnik_old.log")
-        except:
-            log.error("Unable to move old log file. Appending new logs.")
-
-    logfile = logging.FileHandler("logs/sputnik.log",mode='a')
-    logfile.setFormatter(logging.Formatter(
-        fmt=format
-    ))
-    logging.getLogger().addHandler(logfile)
+def logging_setup(config):
+    def number(key, default):
+        value = config.get(0, "Logging", key)
+        return int(value) if value else default
+
+    logfile.setup(
+        level=config.get(0, "Debug", "LogLevel"),
+        max_bytes=number("MaxBytes", 0),
+        max_age=number("MaxAge", 0),
+        backup_count=number("BackupCount", 5),
+        compress=config.get(0, "Logging", "Compress") is not False,
+        json_lines=config.get(0, "Logging", "JsonLines") is True
+    )
 
 # Clean up old songs to limit disk usage
 def clean_data():
@@ -241,11 +399,16 @@ if __name__ == "__main__":
 
     os.chdir(os.path.dirname(os.path.abspath(__file__))+"/..")
 
-    config = Config(test=("--test" in sys.argv))
+    with startup.phase("Config"):
+        config = Config(test=("--test" in sys.argv))
 
-    logging_setup(level=config.get(0, "Debug", "LogLevel"))
-    clean_data()
+    with startup.phase("Logging"):
+        logging_setup(config)
+    with startup.phase("Cleaning data"):
+        clean_data()
 
-    boio = Bot(config, test=("--test" in sys.argv))
+    with startup.phase("Bot init"):
+        boio = Bot(config, test=("--test" in sys.argv))
+    startup.mark("Initialized")
     
     boio.run(config.get(0, "Credentials", "Token"))
@@ -5,51 +5,58 @@ import re
 import io
 import importlib
 import random
+import shlex
+import functools
 import subprocess
 
 from functools import wraps
 from textwrap import dedent
 from datetime import datetime
 
-import aiohttp
-import urllib
 import discord
-import colorlog
-
-import pytesseract
-from PIL import Image
 
 from config import Config
+import fetch
+import logfile
+import logquery
+import metrics
+import ocr
+import profiler
+import recent
 import player
 import dice
+import odds
 
 log = logging.getLogger(__name__)
 
 message_builder = {'content':None, 'file':None, 'embed': None}
 
 class Reply:
-    def __init__(self, content=None, files=None, embed=None):
+    def __init__(self, content=None, files=None, embed=None, on_sent=None):
         self.content=content
         self.files=files
         self.embed=embed
+        # Called with the message once it's been sent
+        self.on_sent=on_sent
 
 class IncorrectUsageError(ValueError):
     pass
 
+# Discord's upload limit outside of servers, which can have bigger ones
+DEFAULT_UPLOAD_LIMIT = 10*1024*1024
+
 ##################################################################
 # Permissions Utilities
 ##################################################################
 
 async def is_owner(bot, message):
-    appInfo = await bot.application_info()
-    return message.author == (appInfo.team.owner, appInfo.owner)[appInfo.team is None]
+    return await bot.permissions.is_owner(message.author)
 
 async def is_dev(bot, message):
-    appInfo = await bot.application_info()
-    return (message.author in appInfo.team.members, False)[appInfo.team is None] or (await is_owner(bot, message))
+    return await bot.permissions.is_dev(message.author)
 
 async def is_admin(bot, message):
-    return  message.channel.permissions_for(message.author).administrator or (await is_dev(bot, message))
+    return await bot.permissions.is_admin(message)
 
 
 ##################################################################
@@ -108,6 +115,8 @@ def mention_invoker(func):
     async def wrapper(bot, message, *args, **kwargs):
         reply = await func(bot, message, *args, **kwargs)
         if isinstance(reply, list):
+            if not reply:
+                return reply
             first = reply.pop(0)
             first.content = "{}, {}".format(message.author.mention, first.content)
             reply.insert(0, first)
@@ -269,37 +278,127 @@ async def cmd_logs(bot, message):
     """
     Usage:
         {command_prefix}logs [current|old]
+        {command_prefix}logs [level=LEVEL] [since=DURATION] [grep=PATTERN]
 
     Displays as many log lines as will fit into a single message, or, if specified, uploads either the current or previous log file. 
+    Can also search the current and archived logs for records at or above a level, newer than a duration (like 30s, 10m, 2h or 1d), or matching a pattern.
     """
     try:
         specify = message.content.split(" ", 1)[1]
+    except IndexError:
+        content = "Here are the last %d lines from the log:\n```\u200b%s```"
+        lines = await bot.loop.run_in_executor(None, logquery.tail, "logs/sputnik.log", 2000-len(content))
+        return Reply(content=content % (len(lines), "".join(lines)))
 
+    if specify in ("current", "old"):
         content = "Here's the log file you requested:"
         
         if specify=="current":
             logFile = discord.File(open("logs/sputnik.log", 'rb'))
         elif specify == "old":
-            logFile = discord.File(open("logs/sputnik_old.log", 'rb'))
+            logFile = discord.File(open(logfile.archive_name(), 'rb'))
 
         return Reply(content=content, files=[logFile,])
 
+    try:
+        options = dict(option.split("=", 1) for option in shlex.split(specify))
+        if set(options) - {"level", "since", "grep"}:
+            raise IncorrectUsageError
+        since = logquery.parse_duration(options["since"]) if "since" in options else None
+        records, total = await bot.loop.run_in_executor(
+            None, functools.partial(logquery.query, level=options.get("level"), since=since, grep=options.get("grep"))
+        )
+    except (ValueError, re.error):
+        raise IncorrectUsageError
+
+    content = "Found %d matching records, here are the most recent %d:\n```\u200b%s```"
+    logs = ""
+    lineCount = 0
+    for record in reversed(records):
+        record = record[-1500:]
+        if len(record)+len(content)+len(logs)<1980:
+            logs = record+logs
+            lineCount+=1
+        else:
+            break
+
+    return Reply(content=content % (total, lineCount, logs))
+
+@dev_only
+@available_everywhere
+async def cmd_stats(bot, message):
+    """
+    Usage:
+        {command_prefix}stats
+
+    Displays command throughput and latency, along with how busy the music and background workers are.
+    The same numbers are served to Prometheus, if the metrics server is enabled.
+    """
+    def ms(seconds):
+        return "-" if seconds is None else "%dms" % (seconds*1000)
+
+    runs = {}
+    for (command, result), count in metrics.COMMANDS.collect().items():
+        total, errors = runs.get(command, (0, 0))
+        runs[command] = (total + count, errors + (count if result != "ok" else 0))
+
+    lines = ["%-14s %6s %6s %8s %8s" % ("command", "runs", "errors", "p50", "p99")]
+    for command, (total, errors) in sorted(runs.items(), key=lambda item: -item[1][0]):
+        lines.append("%-14s %6d %6d %8s %8s" % (
+            command, total, errors,
+            ms(metrics.COMMAND_LATENCY.quantile(0.5, command=command)),
+            ms(metrics.COMMAND_LATENCY.quantile(0.99, command=command))
+        ))
+
+    lines.append("")
+    lines.append("yt_dlp extract p50/p99: %s / %s" % (ms(metrics.YTDL_EXTRACT.quantile(0.5)), ms(metrics.YTDL_EXTRACT.quantile(0.99))))
+    lines.append("yt_dlp download p50/p99: %s / %s" % (ms(metrics.YTDL_DOWNLOAD.quantile(0.5)), ms(metrics.YTDL_DOWNLOAD.quantile(0.99))))
+    for (executor,), depth in sorted(metrics.EXECUTOR_QUEUE.collect().items()):
+        lines.append("%s executor queue: %d" % (executor, depth))
+    if bot.watchdog:
+        lag = bot.watchdog.percentiles()
+        lines.append("Loop lag p50/p90/p99: %s / %s / %s" % (ms(lag[0.5]), ms(lag[0.9]), ms(lag[0.99])))
+    lines.append("Voice sessions: %d" % sum(metrics.VOICE_SESSIONS.collect().values()))
+    lines.append("Queued songs: %d" % sum(metrics.QUEUED_SONGS.collect().values()))
+    for cache, (hits, misses) in sorted(metrics.cache_hit_rates().items()):
+        lines.append("%s cache: %d%% of %d hit" % (cache, 100*hits/(hits+misses), hits+misses))
+
+    return Reply(content="```\n%s```" % "\n".join(lines)[:1990])
+
+@dev_only
+@available_everywhere
+async def cmd_profile(bot, message):
+    """
+    Usage:
+        {command_prefix}profile [seconds]
+
+    Samples what every thread I'm running is doing for the given number of seconds (default 10, at most 120),
+    then uploads a table of the busiest functions and a collapsed stack file for making flame graphs.
+    """
+    try:
+        seconds = float(message.content.split(" ", 1)[1])
     except IndexError:
-        content = "Here are the last %d lines from the log:\n```\u200b%s```"
-        lineCount = 0
-        with open("logs/sputnik.log", "r") as f:
-            lines = f.readlines()
-            lines.reverse()
-            logs=""
-            for line in lines:
-                if len(line)+len(content)+len(logs)<2000:
-                    logs=line+logs
-                    lineCount+=1
-                else:
-                    break
-        
-        content = content % (lineCount, logs)
-        return Reply(content=content)
+        seconds = 10
+    except ValueError:
+        raise IncorrectUsageError
+
+    if not 0 < seconds <= 120:
+        raise IncorrectUsageError
+
+    await message.channel.send(content="Profiling for %gs..." % seconds)
+    try:
+        result = await profiler.profile(seconds)
+    except RuntimeError:
+        return Reply(content="I'm already being profiled, try again once that's done.")
+
+    top = result.top()
+    return Reply(
+        content="```\n%s```" % top[:1900],
+        files=[
+            discord.File(io.BytesIO(top.encode()), filename="profile.txt"),
+            discord.File(io.BytesIO(result.collapsed().encode()), filename="profile.folded"),
+        ]
+    )
 
 @dev_only
 @available_everywhere
@@ -387,6 +486,37 @@ async def cmd_reminder(bot, msg):
     I'll do my best to remember, but please don't use this for anything critical--it's possible something could go wrong, and I could forget.
     """
 
+async def read_image(bot, key, guild, url, on_queued=None):
+    """
+    Yields the text in the image at url, a piece at a time as big images are read, or all at once
+    from the cache if it's been read before.
+    """
+    cache = bot.ocr_cache
+    lang = bot.ocr.lang
+
+    if cache:
+        transcript = await bot.loop.run_in_executor(None, cache.get_url, url, lang)
+        if transcript is not None:
+            yield transcript
+            return
+
+    image = await bot.fetcher.read(url)
+
+    if cache:
+        transcript, cache_key = await bot.loop.run_in_executor(None, cache.get, image, lang)
+        if transcript is not None:
+            await bot.loop.run_in_executor(None, cache.remember_url, url, cache_key)
+            yield transcript
+            return
+
+    pieces = []
+    async for piece in bot.ocr.read_progressively(key, guild, image, lang, on_queued=on_queued):
+        pieces.append(piece)
+        yield piece
+
+    if cache:
+        await bot.loop.run_in_executor(None, cache.put, url, cache_key, lang, "".join(pieces))
+
 @available_everywhere
 @mention_invoker
 async def cmd_read(bot, msg):
@@ -395,34 +525,64 @@ async def cmd_read(bot, msg):
         {command_prefix}read
 
     Attempt to transcribe the text in the most recent image message sent to this channel. Limited to 15 messages of history. 
+    If I'm busy reading other images, I'll let you know where you are in line. Delete your message to cancel.
+    Long images are read a piece at a time, and I'll send each part as soon as I've read it.
     """
+    async def queued(ahead):
+        if ahead:
+            await msg.channel.send(content="{}, I'm busy reading other images right now. There {} ahead of yours.".format(msg.author.mention, "is 1" if ahead == 1 else "are %d" % ahead))
+        else:
+            await msg.channel.send(content="{}, I'm busy reading another image right now, yours is next.".format(msg.author.mention))
+
+    seen, certain = bot.recent.find(msg.channel.id, msg.id + 1, lambda seen: seen.image_url, limit=15)
+    url = seen.image_url if seen else None
+    if not seen and not certain:
+        async for message in msg.channel.history(limit=15):
+            url = recent.image_url(message)
+            if url:
+                break
 
-    async for message in msg.channel.history(limit=15):
-        if message.attachments or message.embeds:
-
-            if message.attachments:
-                url = message.attachments[0].url
-            elif message.embeds[0].image:
-                url = message.embeds[0].image.url
-            elif message.embeds[0].thumbnail:
-                url = message.embeds[0].thumbnail.url
-            request = urllib.request.Request(url, headers={"User-Agent": "Sputnik is a good bot, pls let me read this"})
-            with urllib.request.urlopen(request) as embed:
-                meme = io.BytesIO(embed.read())
-                transcript = pytesseract.image_to_string(Image.open(meme), lang="eng+spa+fra+fin")
-                
-                if transcript: 
-                    transcript = transcript.replace('|','I')
-                    replies = [Reply(content="I took a look at it, and here's my best guess for what it says:"),]
-                    while(len(transcript)>0):
-                        chunk, transcript = transcript[:1900], transcript[1900:]
-                        replies.append(Reply(content="```\n"+chunk+"```"))
-                    return replies
-                else: 
-                    return Reply(content = "I took a look at it, but I couldn't read any text there, sorry.")
-            return Reply(content=content)
-    
-    return Reply(content="Sorry, I didn't find any images that I could read.")
+    if not url:
+        return Reply(content="Sorry, I didn't find any images that I could read.")
+
+    # Sent as it's read, in as few messages as possible: the first part straight away, then each full message's worth
+    transcript, sent = "", 0
+    try:
+        async for piece in read_image(bot, msg.id, msg.guild.id if msg.guild else msg.channel.id, url, on_queued=queued):
+            transcript += piece.replace('|','I')
+            if not sent and transcript.strip():
+                await msg.channel.send(content="{}, I took a look at it, and here's my best guess for what it says:".format(msg.author.mention))
+                await msg.channel.send(content="```\n"+transcript[:1900]+"```")
+                sent = len(transcript[:1900])
+            while sent and len(transcript) - sent >= 1900:
+                await msg.channel.send(content="```\n"+transcript[sent:sent+1900]+"```")
+                sent += 1900
+    except fetch.TooLarge:
+        return Reply(content="That image is too big for me to read, sorry.")
+    except fetch.FetchError:
+        log.exception("Unable to download image to read")
+        return Reply(content="I couldn't download that image, sorry.")
+    except ocr.JobCancelled:
+        return []
+    except ocr.QueueFull:
+        return Reply(content="I've got too many images to read right now, try again in a little while.")
+    except ocr.JobTimeout:
+        if sent:
+            return Reply(content="that's as much as I could make out, sorry.")
+        return Reply(content="I looked at it for as long as I could, but I couldn't make out what it says, sorry.")
+    except ocr.OcrError:
+        # Already logged by the scheduler
+        if sent:
+            return Reply(content="that's as much as I could make out, sorry.")
+        return Reply(content="Something went wrong while I was reading that image, sorry.")
+
+    if not sent:
+        return Reply(content = "I took a look at it, but I couldn't read any text there, sorry.")
+
+    while sent < len(transcript.rstrip()):
+        await msg.channel.send(content="```\n"+transcript[sent:sent+1900]+"```")
+        sent += 1900
+    return []
 
 @available_everywhere
 async def cmd_spoiler(bot, message):
@@ -435,33 +595,59 @@ async def cmd_spoiler(bot, message):
     Will delete the invoking message if I have the correct permissions. 
     """
 
-    images = [
-        discord.File(
-            io.BytesIO(urllib.request.urlopen(
-                urllib.request.Request(attachment.url, headers={"User-Agent": "Sputnik is a good bot, pls let me read this"})
-            ).read()), 
-            filename=attachment.filename, 
-            spoiler=True
-        )
-        for attachment in message.attachments
-    ]
-    
-    if len(images)==0:
+    if not message.attachments:
         raise IncorrectUsageError
-    
-    image_message = message.content.split(" ", 1)[1] if len(message.content.split(" ", 1))>1 else discord.Embed.Empty
 
+    # Discord tells us how big everything is up front, so there's no need to download anything to find out it won't fit
+    limit = message.guild.filesize_limit if message.guild else DEFAULT_UPLOAD_LIMIT
+    total = sum(attachment.size for attachment in message.attachments)
+    if total > limit:
+        return Reply(content="Those are too big for me to re-upload, sorry. I can only send {:.0f}MB at once here.".format(limit/1024/1024))
 
-    embed = discord.Embed(title=discord.Embed.Empty, description=image_message)
-    embed.set_author(name=message.author.display_name, icon_url=message.author.avatar_url)
+    image_message = message.content.split(" ", 1)[1] if len(message.content.split(" ", 1))>1 else None
 
     try:
-        await message.delete()
-        embed.set_footer(text="Original message deleted.")
-    except (discord.Forbidden):
-        embed.set_footer(text="Please delete the original message.")
+        with bot.upload_budget.reserve(message.guild.id if message.guild else message.channel.id, total):
+            downloads = await asyncio.gather(
+                *(bot.fetcher.spool(attachment.url, max_bytes=limit) for attachment in message.attachments),
+                return_exceptions=True
+            )
+            failures = [download for download in downloads if isinstance(download, BaseException)]
+            if failures:
+                for download in downloads:
+                    if not isinstance(download, BaseException):
+                        download.close()
+                raise failures[0]
 
-    return Reply(embed=embed, files=images)
+            images = [
+                discord.File(download, filename=attachment.filename, spoiler=True)
+                for attachment, download in zip(message.attachments, downloads)
+            ]
+
+            embed = discord.Embed(title=None, description=image_message)
+            embed.set_author(name=message.author.display_name, icon_url=message.author.display_avatar.url)
+
+            try:
+                await message.delete()
+                embed.set_footer(text="Original message deleted.")
+            except (discord.Forbidden):
+                embed.set_footer(text="Please delete the original message.")
+
+            # Sent from here, rather than returned, so the files are uploaded before the budget's given back
+            try:
+                await message.channel.send(embed=embed, files=images)
+            finally:
+                for download in downloads:
+                    download.close()
+    except fetch.OverBudget:
+        return Reply(content="I'm already re-uploading a lot for this server, try again once that's done.")
+    except fetch.TooLarge:
+        return Reply(content="One of those is too big for me to re-upload, sorry.")
+    except fetch.FetchError:
+        log.exception("Unable to download attachments to re-upload")
+        return Reply(content="I couldn't download those to re-upload them, sorry.")
+
+    return []
 
 async def cmd_help(bot, message):
     """
@@ -500,35 +686,148 @@ async def cmd_help(bot, message):
         return Reply(content=helpmsg)
 
 @mention_invoker
-async def cmd_roll(self, message):
+async def cmd_roll(bot, message):
     """
     Usage:
-        {command_prefix}roll [X]dY[(+|-|*)Z] [message]
+        {command_prefix}roll [--log] [X]dY[(+|-|*)Z] [message]
+        {command_prefix}roll Nx [X]dY[(+|-|*)Z]
 
     Used to roll X (default 1) dice with Y sides, and an optional modifier of Z (which can be additional dice rolls). 
     Multiple rolls can be specified as a comma separate list.
     A message can also be specified, and will be returned alongside the results.
+    Big rolls are summarised. Use --log to have every die listed in an attached file.
+    Nx rolls the whole thing N times, and shows how the totals came out.
     """
 
 
     try:
         string = message.content.split(" ",1)[1]
-        rolls = dice.DiceSet()
+        log = None
+        if string.startswith("--log "):
+            string = string.split(" ",1)[1]
+            log = []
+        repeat = re.match(r"(\d+)x\s+", string)
+        if repeat:
+            string = string[repeat.end():]
+        rolls = dice.DiceSet(
+            summarize=int(bot.config.get(0, "Dice", "SummaryThreshold") or dice.SUMMARY_THRESHOLD),
+            maxDice=int(bot.config.get(0, "Dice", "MaxDice") or dice.MAX_DICE)
+        )
         rolls.parseString(string)
+    except (IndexError, dice.NoRolls):
+        raise IncorrectUsageError
+    except dice.DiceError as e:
+        return Reply(content=str(e))
+
+    if repeat:
+        trials = int(repeat.group(1))
+        max_trials = int(bot.config.get(0, "Dice", "MaxTrials") or 100000)
+        if not 0 < trials <= max_trials:
+            return Reply(content="I can only roll something between 1 and {} times at once".format(max_trials))
+        if len(rolls.program.expressions) > 2:
+            # Any more histograms won't fit in a message
+            return Reply(content="I can only repeat up to two rolls at once")
+        try:
+            bot.dice_budget.spend(message.guild.id if message.guild else message.channel.id, trials * max(rolls.program.dice, 1))
+        except dice.OverBudget as e:
+            return Reply(content=str(e))
+
+        def simulate():
+            return "\n\n".join(dice.describe(totals) for totals in rolls.program.simulate(trials))
+        return Reply(content="{}\n{}".format(string, await bot.loop.run_in_executor(None, simulate)))
+
+    if rolls.program.dice > rolls.summarize or log is not None:
+        result = await bot.loop.run_in_executor(None, rolls.result, log)
+    else:
+        result = rolls.result()
+
+    files = None
+    if log is not None:
+        data = "\n".join(log).encode()
+        if len(data) > (message.guild.filesize_limit if message.guild else DEFAULT_UPLOAD_LIMIT):
+            result += "\n(The full log is too big to attach)"
+        else:
+            files = [discord.File(io.BytesIO(data), filename="rolls.txt")]
+    return Reply(content=result, files=files)
+cmd_r = cmd_roll
+
+COMPARISONS = {
+    ">=": ("at least", lambda odds, x: odds.at_least(x)),
+    ">": ("more than", lambda odds, x: odds.at_least(x+1)),
+    "<=": ("at most", lambda odds, x: odds.at_most(x)),
+    "<": ("less than", lambda odds, x: odds.at_most(x-1)),
+    "=": ("exactly", lambda odds, x: odds.exactly(x)),
+}
 
-        return Reply(content=rolls.result())
+@mention_invoker
+async def cmd_odds(bot, message):
+    """
+    Usage:
+        {command_prefix}odds [X]dY[(+|-|*)Z] [(>=|>|<=|<|=) N]
+
+    Works out exactly how a roll is likely to go: its average, how much it varies, and the chance of
+    each result. Give a target, like >= 15, to get the chance of hitting it.
+    """
+    try:
+        string = message.content.split(" ",1)[1]
     except IndexError:
         raise IncorrectUsageError
-cmd_r = cmd_roll
+
+    target = re.fullmatch(r"(.*?)\s*(>=|>|<=|<|=)\s*(-?\d+)\s*", string)
+    if target:
+        string = target.group(1)
+
+    try:
+        results = await bot.loop.run_in_executor(None, odds.odds, string)
+    except dice.NoRolls:
+        raise IncorrectUsageError
+    except dice.DiceError as e:
+        return Reply(content=str(e))
+
+    lines = []
+    for distribution in results:
+        lines.append("average {:.2f}, standard deviation {:.2f}, from {} to {}".format(
+            distribution.mean(), distribution.variance()**0.5, distribution.lowest, distribution.highest
+        ))
+        if target:
+            words, chance = COMPARISONS[target.group(2)]
+            lines.append("chance of {} {}: {:.2%}".format(words, target.group(3), chance(distribution, int(target.group(3)))))
+
+    if len(results) == 1 and len(results[0]) <= 30:
+        distribution = results[0]
+        width = max(distribution.listed())
+        lines.append("```")
+        for value, chance in distribution.outcomes():
+            lines.append("{:>4} {:>7.2%} {}".format(value, chance, "#" * round(20*chance/width)))
+        lines.append("```")
+
+    return Reply(content="{}\n{}".format(string, "\n".join(lines)))
 
 async def cmd_suggestions(bot, message):
     """
     Usage:
-        {command_prefix}suggestions
+        {command_prefix}suggestions [search]
 
     Lists previous suggestions, as well as their authors.
+    If search terms are given, only lists the suggestions that best match them.
     """
-    
+    if not bot.suggestions or not await bot.suggestions.ready():
+        return Reply(content="Sorry, I can't get to the suggestion board right now.")
+
+    try:
+        query = message.content.split(" ", 1)[1].strip()
+    except IndexError:
+        query = ""
+
+    if query:
+        results = bot.suggestions.search(query, limit=10)
+        if not results:
+            return Reply(content="I couldn't find any suggestions like that.")
+        embed = discord.Embed(title="**Suggestions matching** {}".format(query[:200]), description=None)
+        for score, card in results:
+            embed.add_field(name=card.name, inline=False, value="{} - suggested {} by {}\n{}\n\u200b".format(card.column, card.suggested_on[:10], card.suggested_by, card.description[:300]))
+        return Reply(embed=embed)
+
     replies = []
 
     title_embed = discord.Embed(title="**Suggestion List**", description="A full view of all suggestions can be found on the [Sputnik Development Trello Board](https://trello.com/b/59hNomms/sputnik-development)\n\n")
@@ -538,38 +837,60 @@ async def cmd_suggestions(bot, message):
     cards = bot.suggestions.get_suggestion_categories()
 
     for col in cards.keys():
-        embed = discord.Embed(title=f"{col}", description=discord.Embed.Empty)
+        embed = discord.Embed(title=f"{col}", description=None)
         for card in cards[col]:
-            embed.add_field(name=card.name, inline=False, value="Suggested {} by {}\nDescription:\n{}\n\u200b".format(card.get_custom_field_by_name("Suggested On").value[:10], card.get_custom_field_by_name("Suggested By").value, card.description))
+            embed.add_field(name=card.name, inline=False, value="Suggested {} by {}\nDescription:\n{}\n\u200b".format(card.suggested_on[:10], card.suggested_by, card.description))
         if len(cards[col])==0:
             embed.add_field(name="No tasks currently in this column!", inline=False, value="\u200b")
         replies.append(Reply(embed=embed))
 
 #    for card in bot.suggestions.get_suggestions():
-#        embed.add_field(name=card.name, value="Suggested {} by {}\u2003\u2003\u2003\u2003Status: {}\nDescription:\n{}\n\u200b".format(card.get_custom_field_by_name("Suggested On").value[:10], card.get_custom_field_by_name("Suggested By").value, card.get_list().name, card.description), inline=True)
+#        embed.add_field(name=card.name, value="Suggested {} by {}\u2003\u2003\u2003\u2003Status: {}\nDescription:\n{}\n\u200b".format(card.suggested_on[:10], card.suggested_by, card.column, card.description), inline=True)
 
     return replies
 
 async def cmd_suggest(bot, message): 
     """
     Usage:
-        {command_prefix}suggest title
+        {command_prefix}suggest [-f] title
         description
 
     Used to suggest additional features for Sputnik. All suggestions get added to the Sputnik Trello board, which Ada checks whenever she's doing dev work.
-    Before suggesting a new feature, consider using '{command_prefix}suggestions' to make sure it isn't a duplicate.
+    If it looks like something's already been suggested, you'll be shown the existing suggestions instead. Use -f to suggest it anyway.
     """
     try:
         suggestion = message.content.split(" ", 1)[1]
     except IndexError:
         raise IncorrectUsageError
 
+    if not bot.suggestions:
+        return Reply(content="Sorry, I can't get to the suggestion board right now.")
+
+    force = suggestion.startswith("-f ")
+    if force:
+        suggestion = suggestion[3:].lstrip()
+
     title = suggestion.split("\n", 1)[0]
 
     try: 
         description = suggestion.split("\n", 1)[1]
     except IndexError:
         description=""
+
+    if not title.strip():
+        raise IncorrectUsageError
+
+    prefix = bot.config.get((message.guild.id if message.guild else "default"), "Server", "CommandPrefix")
+    if not force and not await bot.suggestions.ready():
+        # An empty board would say there are no duplicates of anything
+        return Reply(content="Sorry, I can't check the suggestion board for duplicates right now. Use `{}suggest -f` to suggest it anyway.".format(prefix))
+
+    duplicates = [] if force else bot.suggestions.find_duplicates(title, description)
+    if duplicates:
+        embed = discord.Embed(title="**That might already have been suggested**", description="If it's something different, use `{}suggest -f` to suggest it anyway.".format(prefix))
+        for score, card in duplicates:
+            embed.add_field(name=card.name, inline=False, value="{} - suggested {} by {}\n{}\n\u200b".format(card.column, card.suggested_on[:10], card.suggested_by, card.description[:300]))
+        return Reply(embed=embed)
     
     bot.suggestions.add_suggestion(title, description[:1000], message.author.display_name)
 
@@ -589,19 +910,32 @@ async def cmd_quote(bot, msg):
     """
 
     if msg.mentions:
-        quoteMessage = await msg.channel.history(before=msg).get(author=msg.mentions[0])
+        quoteMessage, certain = bot.recent.find(msg.channel.id, msg.id, lambda seen: seen.author.id == msg.mentions[0].id)
+        if not quoteMessage:
+            async for message in msg.channel.history(limit=100, before=msg):
+                if message.author.id == msg.mentions[0].id:
+                    quoteMessage = message
+                    break
     else:
         try:
             quoteId = int(msg.content.split(" ", 1)[1])
-            try:
-                quoteMessage = await msg.channel.fetch_message(quoteId)
-            except discord.NotFound:
-                return Reply(content="No message with that ID found in this channel.")
+            quoteMessage = bot.recent.get(msg.channel.id, quoteId)
+            if not quoteMessage:
+                try:
+                    quoteMessage = await msg.channel.fetch_message(quoteId)
+                except discord.NotFound:
+                    return Reply(content="No message with that ID found in this channel.")
         except IndexError:
-            quoteMessage = await msg.channel.history(limit=1, before=msg).next()
+            quoteMessage, certain = bot.recent.find(msg.channel.id, msg.id)
+            if not quoteMessage:
+                async for message in msg.channel.history(limit=1, before=msg):
+                    quoteMessage = message
+
+    if not quoteMessage:
+        return Reply(content="I couldn't find a message to quote.")
     
-    quoteEmbed = discord.Embed(title=discord.Embed.Empty, description=quoteMessage.content)
-    quoteEmbed.set_author(name=quoteMessage.author.display_name, icon_url=quoteMessage.author.avatar_url)
+    quoteEmbed = discord.Embed(title=None, description=quoteMessage.content)
+    quoteEmbed.set_author(name=quoteMessage.author.display_name, icon_url=quoteMessage.author.display_avatar.url)
     return Reply(embed=quoteEmbed)
 
 # Fun Commands
@@ -638,8 +972,6 @@ async def cmd_hug(bot, message):
 
     Sends a virtual hug to the user, or to the specified users or roles.
     """
-    hug = [discord.File(open("virtual_hug.gif", 'rb')), ]
-
     embed_content=""
     content=None
     if message.mentions:
@@ -652,24 +984,23 @@ async def cmd_hug(bot, message):
                 embed_content += ":heart: %s :heart:\n" % role.mention
             else: 
                 content = "The rules say I'm not allowed to hug %s :cry:\n" % role.mention
-                hug = None
                 break
     elif message.mention_everyone:
-        if is_admin(bot, message):
+        if await is_admin(bot, message):
             embed_content = ":heart: @everyone :heart:"
         else:
             content = "Sorry, but I don't think that's a good idea..."
-            hug = None
     else:
         embed_content = ":heart: %s :heart:" % message.author.mention
     
     if content:
-        embed = None
-    else: 
-        embed = discord.Embed(title=discord.Embed.Empty, description=embed_content)
-        embed.set_author(name=message.author.display_name, icon_url=message.author.avatar_url)
+        return Reply(content=content)
 
-    return Reply(content=content, embed=embed, files=hug)
+    embed = discord.Embed(title=None, description=embed_content)
+    embed.set_author(name=message.author.display_name, icon_url=message.author.display_avatar.url)
+    hug = bot.assets.attach("hug", embed)
+
+    return Reply(embed=embed, files=hug, on_sent=functools.partial(bot.assets.sent, "hug"))
 
 @owner_only
 @available_everywhere
@@ -680,10 +1011,6 @@ async def cmd_guillotine(bot, message):
 
     Sends the user, or specified users or roles, to the guillotine. 
     """
-    await message.channel.trigger_typing()
-
-    guillotine = [discord.File(open("guillotine.gif", 'rb')), ]
-
     embed_content=""
     content=None
     if message.mentions:
@@ -696,19 +1023,19 @@ async def cmd_guillotine(bot, message):
                 embed_content += ":skull_crossbones: %s :skull_crossbones:\n" % role.mention
             else: 
                 content = "The rules say I'm not allowed to execute %s :cry:\n" % role.mention
-                guillotine = None
                 break
 
     else:
         embed_content = ":skull_crossbones: %s :skull_crossbones:" % message.author.mention
     
     if content:
-        embed = None
-    else: 
-        embed = discord.Embed(title=discord.Embed.Empty, description=embed_content)
-        embed.set_author(name=message.author.display_name, icon_url=message.author.avatar_url)
+        return Reply(content=content)
+
+    embed = discord.Embed(title=None, description=embed_content)
+    embed.set_author(name=message.author.display_name, icon_url=message.author.display_avatar.url)
+    guillotine = bot.assets.attach("guillotine", embed)
 
-    return Reply(content=content, embed=embed, files=guillotine)
+    return Reply(embed=embed, files=guillotine, on_sent=functools.partial(bot.assets.sent, "guillotine"))
 
 # Music Commands
 #################
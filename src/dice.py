@@ -1,8 +1,24 @@
 import re
+import time
+import math
+import json
+import heapq
 import random
 import sys
+import itertools
 
-expression = re.compile('(((?P<dieCount>\d*)([dD])(?P<dieSides>\d+)(((?P<dropLowest>dl)(?P<dropLowestCount>\d*))?((?P<dropHighest>dh)(?P<dropHighestCount>\d*))?)?|(?P<staticValue>\d+))((?P<nextJoiner>[+*-])|(,\s*))?)+?')
+from collections import Counter, deque
+from functools import lru_cache
+
+try:
+    import numpy
+    generator = numpy.random.default_rng()
+except ImportError:
+    numpy = None
+
+# A single roll or number, and whatever joins it to the next one
+term = re.compile(r'(?P<dieCount>\d*)[dD](?P<dieSides>\d+)((?P<dropLowest>dl)(?P<dropLowestCount>\d*))?((?P<dropHighest>dh)(?P<dropHighestCount>\d*))?|(?P<staticValue>\d+)')
+join = re.compile(r'(?P<operator>[+*-])|,\s*')
 
 
 def addition(x, y): return x+y
@@ -17,98 +33,439 @@ joiner = {
     '*': multiply
 }
 
+precedence = {
+    '+': 1,
+    '-': 1,
+    '*': 2
+}
+
+# Rolls of more dice than this are summarised instead of listing every die
+SUMMARY_THRESHOLD = 100
+# Most dice a single roll command can ask for
+MAX_DICE = 1000000
+# Rolls of at least this many dice go through numpy, when it's around
+VECTORIZE_THRESHOLD = 64
+# Dice with up to this many sides get a count of each face in their summary
+HISTOGRAM_SIDES = 20
+# Most dice simulated at once, so repeated rolls of big pools are done in slices
+SIMULATION_CHUNK = 1000000
+# random.choices picks faces from a float, which only has enough bits to be fair for dice up to this big
+CHOICE_SIDES = 2**53
+
+class DiceError(ValueError):
+    pass
+
+class NoRolls(DiceError):
+    pass
+
+class OverBudget(DiceError):
+    pass
+
+class Budget:
+    """
+    How many dice each guild can roll, refilling steadily over time, so one server rolling huge
+    batches over and over can't hog the bot.
+    """
+    def __init__(self, capacity, refill):
+        self.capacity = capacity
+        self.refill = refill
+        self.levels = {}    # key -> (dice left, when)
 
-class DiceNode:
-    def __init__(self, capture):
-        self.nextRoll = None
-        self.nextJoiner = None
-        self.sum = None
-        self.string = ""
+    def spend(self, key, dice):
+        now = time.monotonic()
+        left, when = self.levels.get(key, (self.capacity, now))
+        left = min(self.capacity, left + (now - when) * self.refill)
+        if dice > left:
+            if dice > self.capacity:
+                raise OverBudget(f"That's more than the {self.capacity} dice I can roll at once")
+            raise OverBudget(f"That's too much rolling for now, try again in {math.ceil((dice - left) / self.refill)} seconds")
+        self.levels[key] = (left - dice, now)
 
-        self.parse(capture)
+class Static:
+    def __init__(self, value):
+        self.value = value
+        self.key = ("static", value)
+
+    def evaluate(self, summarize, log):
+        return self.value, str(self.value)
+
+    def simulate(self, trials, vectorized):
+        return numpy.full(trials, self.value, dtype=numpy.int64) if vectorized else [self.value]*trials
+
+class Roll:
+    def __init__(self, count, sides, dropLowest=0, dropHighest=0):
+        if sides < 1:
+            raise DiceError("Dice need at least one side")
+        if dropLowest + dropHighest > count:
+            raise DiceError("Can't drop more dice than are rolled")
+        self.count = count
+        self.sides = sides
+        self.dropLowest = dropLowest
+        self.dropHighest = dropHighest
+        self.dropMessage = (f"dl{dropLowest}" if dropLowest else "") + (f"dh{dropHighest}" if dropHighest else "")
+        # Two parts of an expression with the same key always roll the same way
+        self.key = ("roll", count, sides, dropLowest, dropHighest)
+
+    def evaluate(self, summarize, log):
+        # numpy only pays for itself on big rolls, and only works while the total fits in 64 bits
+        vectorized = numpy is not None and self.count >= VECTORIZE_THRESHOLD and self.count*self.sides < 2**62
+        if vectorized:
+            results = generator.integers(1, self.sides, size=self.count, endpoint=True)
+        else:
+            results = self.faces()
+        dropped = self.drop(results, vectorized)
+
+        if vectorized:
+            total = int(results.sum() - results[dropped].sum())
+        else:
+            total = sum(results) - sum(results[i] for i in dropped)
 
-    def joinNext(self):
-        if self.nextRoll:
-            if self.nextJoiner:
-                self.sum = joiner[self.nextJoiner](self.sum, self.nextRoll.sum)
-                self.string = f"({self.string}) {self.nextJoiner} ({self.nextRoll.string}) = {self.sum}"
+        if log is not None or self.count <= summarize:
+            # Dice are dropped by value, but shown in the order they were rolled
+            droppedSet = set(dropped.tolist() if vectorized else dropped)
+            resultString = ", ".join([str(result) if i not in droppedSet else f"~~{result}~~" for i, result in enumerate(results.tolist() if vectorized else results)])
+            if log is not None:
+                log.append(f"{self.count}d{self.sides}{self.dropMessage}: {resultString} = {total}")
+        if self.count > summarize:
+            resultString = self.summary(results, dropped, vectorized)
+        return total, f"{self.count}d{self.sides}{self.dropMessage} ({resultString}) = {total}"
+
+    def simulate(self, trials, vectorized):
+        """
+        The total of this roll, rolled trials times over.
+        """
+        if not vectorized:
+            return [self.total() for i in range(trials)]
+        if not self.count:
+            return numpy.zeros(trials, dtype=numpy.int64)
+
+        out = numpy.empty(trials, dtype=numpy.int64)
+        step = max(1, SIMULATION_CHUNK // self.count)
+        kth = sorted({k for k in (self.dropLowest-1, self.count-self.dropHighest) if 0 <= k < self.count})
+        for start in range(0, trials, step):
+            results = generator.integers(1, self.sides, size=(min(step, trials-start), self.count), endpoint=True)
+            if self.dropLowest or self.dropHighest:
+                results = numpy.partition(results, kth, axis=1)[:, self.dropLowest:self.count-self.dropHighest]
+            out[start:start+len(results)] = results.sum(axis=1)
+        return out
+
+    def faces(self):
+        if self.sides <= CHOICE_SIDES:
+            return random.choices(range(1, self.sides+1), k=self.count)
+        return [random.randint(1, self.sides) for i in range(self.count)]
+
+    def total(self):
+        results = self.faces()
+        if not self.dropLowest and not self.dropHighest:
+            return sum(results)
+        results.sort()
+        return sum(results[self.dropLowest:self.count-self.dropHighest])
+
+    def drop(self, results, vectorized):
+        """
+        The positions of the dice to drop. Picks them out without sorting the whole roll.
+        """
+        low, high = self.dropLowest, self.dropHighest
+        if not low and not high:
+            return numpy.empty(0, dtype=int) if vectorized else []
+
+        if vectorized:
+            # One partition for both ends, so with ties the same die can't be dropped twice
+            order = numpy.argpartition(results, sorted({k for k in (low-1, self.count-high) if 0 <= k < self.count}))
+            return numpy.concatenate((order[:low], order[self.count-high:]))
+
+        lowest = heapq.nsmallest(low, range(self.count), key=results.__getitem__)
+        skip = set(lowest)
+        return lowest + heapq.nlargest(high, (i for i in range(self.count) if i not in skip), key=results.__getitem__)
+
+    def summary(self, results, dropped, vectorized):
+        if vectorized:
+            kept = numpy.ones(self.count, dtype=bool)
+            kept[dropped] = False
+            kept = results[kept]
+        else:
+            skip = set(dropped)
+            kept = [result for i, result in enumerate(results) if i not in skip]
+
+        if not len(kept):
+            summary = "all dropped"
+        elif self.sides <= HISTOGRAM_SIDES:
+            if vectorized:
+                counts = numpy.bincount(kept, minlength=self.sides+1).tolist()
             else:
-                self.string = f"{self.string}, {self.nextRoll.string}"
-                self.sum = self.nextRoll.sum
-            self.nextJoiner = self.nextRoll.nextJoiner
-            self.nextRoll = self.nextRoll.nextRoll
+                counts = Counter(kept)
+            summary = ", ".join(f"{face}s: {counts[face]}" for face in range(1, self.sides+1))
+        else:
+            lowest, highest = (int(kept.min()), int(kept.max())) if vectorized else (min(kept), max(kept))
+            summary = f"lowest {lowest}, highest {highest}, average {int(kept.sum()) / len(kept) if vectorized else sum(kept) / len(kept):.1f}"
+
+        if len(dropped):
+            summary += f"; {len(dropped)} dropped"
+        return summary
+
+class Operation:
+    """
+    A run of operators of the same precedence, applied left to right.
+    """
+    def __init__(self, first, rest):
+        self.first = first
+        self.rest = rest    # [(operator, operand)]
+        self.key = ("operation", first.key, tuple((operator, operand.key) for operator, operand in rest))
+
+    def evaluate(self, summarize, log):
+        total, string = self.first.evaluate(summarize, log)
+        for operator, operand in self.rest:
+            value, valueString = operand.evaluate(summarize, log)
+            total = joiner[operator](total, value)
+            string = f"({string}) {operator} ({valueString}) = {total}"
+        return total, string
 
-    def parse(self, capture):
+    def simulate(self, trials, vectorized):
+        totals = self.first.simulate(trials, vectorized)
+        for operator, operand in self.rest:
+            values = operand.simulate(trials, vectorized)
+            totals = joiner[operator](totals, values) if vectorized else list(map(joiner[operator], totals, values))
+        return totals
+
+class Program:
+    """
+    A compiled roll: comma separated expressions, the message that came after them, and how many dice it rolls.
+    """
+    def __init__(self, expressions, message, dice, bits=0):
+        self.expressions = expressions
+        self.message = message
+        self.dice = dice
+        self.bits = bits
+
+    def evaluate(self, summarize=SUMMARY_THRESHOLD, log=None):
+        """
+        Rolls everything. Rolls of more than summarize dice are summarised, and if log is a list, every die
+        of every roll is listed in it.
+        """
+        return f"{self.message}{', '.join(string for total, string in self.roll(summarize, log))}"
+
+    def roll(self, summarize=SUMMARY_THRESHOLD, log=None):
+        """
+        Rolls everything, returning the total and the working of each expression.
+        """
+        return [expression.evaluate(summarize, log) for expression in self.expressions]
+
+    def simulate(self, trials):
+        """
+        Rolls each expression trials times over, in bulk, keeping only the totals. Returns a list of totals for
+        each expression, as numpy arrays if numpy's around.
+        """
+        vectorized = numpy is not None and self.bits < 62
+        return [expression.simulate(trials, vectorized) for expression in self.expressions]
+
+def seed(value):
+    """
+    Starts the dice off from a known state, so the same rolls come out every time. value is a string.
+    """
+    global generator
+    random.seed(value)
+    if numpy is not None:
+        generator = numpy.random.default_rng(list(value.encode()))
+
+def statistics(totals):
+    count = len(totals)
+    mean = sum(totals) / count
+    return {
+        "mean": mean,
+        "deviation": math.sqrt(sum((total-mean)**2 for total in totals) / count),
+        "lowest": min(totals),
+        "highest": max(totals),
+    }
+
+def describe(totals, bins=16):
+    """
+    Summary statistics and a text histogram of a batch of totals.
+    """
+    totals = numpy.sort(totals).tolist() if numpy is not None and not isinstance(totals, list) else sorted(totals)
+    count = len(totals)
+    summary = statistics(totals)
+    lowest, highest = totals[0], totals[-1]
+    lines = [
+        f"{count} rolls: average {summary['mean']:.2f}, standard deviation {summary['deviation']:.2f}",
+        f"lowest {lowest}, median {totals[count//2]}, highest {highest}, middle 90% {totals[count//20]} to {totals[count-1-count//20]}"
+    ]
+
+    # One bar per total if there aren't many, otherwise totals grouped into equal ranges
+    width = max(1, math.ceil((highest - lowest + 1) / bins))
+    counts = Counter((total - lowest) // width for total in totals)
+    tallest = max(counts.values())
+    lines.append("```")
+    for group in range((highest - lowest) // width + 1):
+        start = lowest + group*width
+        label = str(start) if width == 1 else f"{start}-{start+width-1}"
+        lines.append(f"{label:>11} {counts[group]/count:>7.2%} {'#' * round(20*counts[group]/tallest)}")
+    lines.append("```")
+    return "\n".join(lines)
+
+def tokenize(string):
+    """
+    Splits the rolls at the start of string into terms, operators and commas, in a single pass.
+    Returns the tokens, and where in string the rolls stopped and the message began.
+    """
+    tokens = []
+    position = 0
+    while True:
+        match = term.match(string, position)
+        if not match:
+            break
+        capture = match.groupdict()
         if capture['staticValue']:
-            self.sum = int(capture['staticValue'])
-            self.string = str(self.sum)
-        else: 
-            sides = int(capture['dieSides'])
-            count = int(capture.get('dieCount') or 1)
-            # Roll the dice, recording their in-order indices, but sorting them in-place according to value
-            results = {i:random.randint(1, sides) for i in range(count)}
-            keys = [k for k, v in sorted(results.items(), key=lambda item: item[1])]
-
-            dropped = [] #indexes (keys)
-            dropMessage = ""
-            if capture['dropLowest']:
-                drop = int(capture.get('dropLowestCount') or 1)            
-                for i in range(drop):
-                    dropped.append(keys[i])
-                dropMessage+=f"dl{drop}"
-                
-
-            if capture['dropHighest']:
-                drop = int(capture.get('dropHighestCount') or 1)
-                for i in range(drop):
-                    dropped.append(keys[-(i+1)])
-                dropMessage+=f"dh{drop}"
-            
-            resultString = ", ".join([str(results[i]) if i not in dropped else f"~~{results[i]}~~" for i in range(len(results))])
-            
-            self.sum = sum([result[1] for result in results.items() if result[0] not in dropped])
-            self.string = f"{count}d{sides}{dropMessage} ({resultString}) = {self.sum}"
-            self.nextJoiner = capture['nextJoiner']
+            tokens.append(Static(int(capture['staticValue'])))
+        else:
+            tokens.append(Roll(
+                int(capture['dieCount'] or 1),
+                int(capture['dieSides']),
+                int(capture['dropLowestCount'] or 1) if capture['dropLowest'] else 0,
+                int(capture['dropHighestCount'] or 1) if capture['dropHighest'] else 0
+            ))
+        position = match.end()
+
+        match = join.match(string, position)
+        if not match:
+            break
+        tokens.append(match.group('operator') or ',')
+        position = match.end()
+
+    # Anything dangling off the end joins on to nothing
+    if tokens and isinstance(tokens[-1], str):
+        tokens.pop()
+    return tokens, position
+
+def parse(tokens, start, level=1):
+    """
+    Builds the expression starting at tokens[start], out of operators of at least the given precedence.
+    Returns it and the index after it.
+    """
+    if level > max(precedence.values()):
+        return tokens[start], start + 1
+
+    first, position = parse(tokens, start, level + 1)
+    rest = []
+    while position < len(tokens) and tokens[position] != ',' and precedence[tokens[position]] == level:
+        operator = tokens[position]
+        operand, position = parse(tokens, position + 1, level + 1)
+        rest.append((operator, operand))
+    return (Operation(first, rest) if rest else first), position
+
+@lru_cache(maxsize=1024)
+def compileRolls(string):
+    tokens, end = tokenize(string)
+    if not tokens:
+        raise NoRolls("No rolls in %r" % string)
+
+    expressions = []
+    position = 0
+    while position < len(tokens):
+        expression, position = parse(tokens, position)
+        expressions.append(expression)
+        # Skip the comma
+        position += 1
+
+    message = string[end:].strip()
+    dice = sum(token.count for token in tokens if isinstance(token, Roll))
+    # More bits than any total could need, to tell whether they fit in numpy's integers
+    bits = sum(math.log2(max(token.count*token.sides if isinstance(token, Roll) else token.value, 2)) for token in tokens if not isinstance(token, str))
+    return Program(tuple(expressions), message+": " if message else "", dice, bits)
 
 
 class DiceSet:
-    def __init__(self):
-        self.firstRoll = None
-        self.message = ""
-
-    def addRoll(self, capture):
-        newRoll = DiceNode(capture)
-        if (self.firstRoll):
-            current = self.firstRoll
-            while (current.nextRoll):
-                current = current.nextRoll
-            current.nextRoll = newRoll
-        else:
-            self.firstRoll = newRoll
-    
-    def result(self):
-        for operation in ['*','+','-',None]:
-            current = self.firstRoll
-            while(current):
-                if current.nextJoiner == operation:
-                    current.joinNext()
-                current = current.nextRoll
-            self.firstRoll.joinNext()
-        return f"{self.message}{self.firstRoll.string}"
-    
+    def __init__(self, summarize=SUMMARY_THRESHOLD, maxDice=MAX_DICE):
+        self.summarize = summarize
+        self.maxDice = maxDice
+        self.program = None
+
     def parseString(self, string):
-        match = expression.match(string)
+        program = compileRolls(string)
+        if self.maxDice and program.dice > self.maxDice:
+            raise DiceError(f"Can't roll more than {self.maxDice} dice at once")
+        self.program = program
+
+    def result(self, log=None):
+        return self.program.evaluate(self.summarize, log)
+
+
+##################################################################
+# Batch mode
+##################################################################
 
-        while (match):
-            self.addRoll(match.groupdict())
-            string = string[match.end():]
-            match = expression.match(string)
+def runChunk(job):
+    """
+    Rolls a chunk of numbered lines, returning a line of JSON for each. Each chunk gets its own random stream,
+    from the seed and its position, so the results don't depend on how chunks are shared out between processes.
+    """
+    number, lines, base, trials, summarize = job
+    if base is not None:
+        seed(f"{base}:{number}")
 
-        if string.strip():
-            self.message = string.strip()+": "
+    out = []
+    for line, text in lines:
+        record = {"line": line, "input": text}
+        try:
+            program = compileRolls(text)
+            if trials:
+                record["trials"] = trials
+                record["rolls"] = [statistics(totals.tolist() if numpy is not None and not isinstance(totals, list) else totals) for totals in program.simulate(trials)]
+            else:
+                rolls = program.roll(summarize)
+                record["totals"] = [total for total, string in rolls]
+                record["result"] = f"{program.message}{', '.join(string for total, string in rolls)}"
+        except DiceError as e:
+            record["error"] = str(e)
+        out.append(json.dumps(record))
+    return out
+
+def batch(source, workers=0, base=None, trials=0, summarize=SUMMARY_THRESHOLD, chunk=256):
+    """
+    Rolls each line of source, yielding a line of JSON for each, in order. Blank lines and lines starting with
+    # are skipped. Lines are read as they're needed, so source can be as long as it likes.
+
+    With workers, chunks of lines are rolled across that many processes, keeping a couple of chunks per
+    process queued up.
+    """
+    lines = ((number, line.strip()) for number, line in enumerate(source, 1) if line.strip() and not line.lstrip().startswith("#"))
+    chunks = ((number, lines, base, trials, summarize) for number, lines in enumerate(iter(lambda: list(itertools.islice(lines, chunk)), [])))
+
+    if not workers:
+        for job in chunks:
+            yield from runChunk(job)
+        return
+
+    import multiprocessing
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        pending = deque()
+        for job in chunks:
+            pending.append(pool.apply_async(runChunk, (job,)))
+            if len(pending) >= workers*2:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
 
 
 if __name__ == "__main__":
-    dice = DiceSet()
-    dice.parseString(" ".join(sys.argv[1:]))
-    print(dice.result())
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Rolls dice, the same way the bot does")
+    parser.add_argument("expression", nargs="*", help="what to roll, if not rolling a batch")
+    parser.add_argument("--batch", metavar="FILE", help="roll each line of FILE (- for stdin), writing a line of JSON for each")
+    parser.add_argument("--workers", type=int, default=0, help="processes to spread a batch across")
+    parser.add_argument("--seed", help="seed for reproducible rolls")
+    parser.add_argument("--trials", type=int, default=0, help="roll each line this many times, and give statistics on the totals")
+    parser.add_argument("--summarize", type=int, default=SUMMARY_THRESHOLD, help="summarise rolls of more dice than this")
+    args = parser.parse_args()
+
+    if args.batch:
+        source = sys.stdin if args.batch == "-" else open(args.batch)
+        with source:
+            for record in batch(source, args.workers, args.seed, args.trials, args.summarize):
+                print(record, flush=args.batch == "-")
+    else:
+        if args.seed is not None:
+            seed(args.seed)
+        dice = DiceSet(summarize=args.summarize, maxDice=None)
+        dice.parseString(" ".join(args.expression))
+        print(dice.result())
@@ -0,0 +1,81 @@
+import json
+import time
+import random
+import itertools
+import threading
+
+class FakeTrelloError(Exception):
+    pass
+
+class FakeTrelloClient:
+    """
+    An in-memory stand-in for the parts of the Trello API that SuggestionList uses, behind the same
+    fetch_json interface as py-trello's TrelloClient. Can be made slow, or made to fail some fraction
+    of requests, to see how the bot copes.
+    """
+    def __init__(self, columns=("Suggested", "In Progress", "Done"), latency=0, failure_rate=0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.requests = []
+
+        self.board = {'id': self.new_id(), 'name': "Sputnik Development"}
+        self.lists = [{'id': self.new_id(), 'name': name} for name in columns]
+        self.custom_fields = [
+            {'id': self.new_id(), 'name': "Suggested By", 'type': 'text'},
+            {'id': self.new_id(), 'name': "Suggested On", 'type': 'date'},
+        ]
+        self.cards = []
+
+    def new_id(self):
+        return "%024x" % next(self.ids)
+
+    def add_card(self, name, desc="", column=0, suggested_by=None, suggested_on=None):
+        card = {'id': self.new_id(), 'name': name, 'desc': desc, 'idList': self.lists[column]['id'], 'customFieldItems': []}
+        for field, value in ((self.custom_fields[0], suggested_by), (self.custom_fields[1], suggested_on)):
+            if value is not None:
+                card['customFieldItems'].append({'idCustomField': field['id'], 'value': {field['type']: value}})
+        self.cards.append(card)
+        return card
+
+    def fetch_json(self, uri_path, http_method='GET', headers=None, query_params=None, post_args=None, files=None):
+        self.requests.append((http_method, uri_path))
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and self.rng.random() < self.failure_rate:
+            raise FakeTrelloError("Simulated failure on %s %s" % (http_method, uri_path))
+
+        with self.lock:
+            # Round trip everything through JSON, so callers can't hold on to our copies
+            return json.loads(json.dumps(self.route(uri_path.strip('/').split('/'), http_method, query_params or {}, post_args or {})))
+
+    def route(self, path, method, query, body):
+        if path == ['members', 'me', 'boards'] and method == 'GET':
+            return [self.board]
+
+        if path[0] == 'boards' and path[1] == self.board['id'] and method == 'GET':
+            board = dict(self.board)
+            if query.get('lists'):
+                board['lists'] = self.lists
+            if query.get('customFields') == 'true':
+                board['customFields'] = self.custom_fields
+            if query.get('cards'):
+                board['cards'] = [
+                    card if query.get('card_customFieldItems') == 'true' else {k: v for k, v in card.items() if k != 'customFieldItems'}
+                    for card in self.cards
+                ]
+            return board
+
+        if path == ['cards'] and method == 'POST':
+            column = next(i for i, column in enumerate(self.lists) if column['id'] == body['idList'])
+            return self.add_card(body['name'], body.get('desc', ""), column)
+
+        if len(path) == 5 and path[0] == 'cards' and path[2] == 'customField' and path[4] == 'item' and method == 'PUT':
+            card = next(card for card in self.cards if card['id'] == path[1])
+            card['customFieldItems'] = [item for item in card['customFieldItems'] if item['idCustomField'] != path[3]]
+            card['customFieldItems'].append({'idCustomField': path[3], 'value': body['value']})
+            return {}
+
+        raise FakeTrelloError("No fake for %s /%s" % (method, "/".join(path)))
@@ -0,0 +1,140 @@
+import io
+import asyncio
+import logging
+import tempfile
+
+from contextlib import contextmanager
+from collections import defaultdict
+
+log = logging.getLogger(__name__)
+
+USER_AGENT = "Sputnik is a good bot, pls let me read this"
+
+class FetchError(Exception):
+    pass
+
+class TooLarge(FetchError):
+    pass
+
+class OverBudget(FetchError):
+    pass
+
+class ByteBudget:
+    """
+    Limits how many bytes can be in flight at once for each guild, so one server re-uploading a pile
+    of videos can't fill up the disk or memory for everyone.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = defaultdict(int)
+
+    @contextmanager
+    def reserve(self, key, size):
+        if self.used[key] + size > self.limit:
+            raise OverBudget("%d bytes would take %s over its limit of %d" % (size, key, self.limit))
+        self.used[key] += size
+        try:
+            yield
+        finally:
+            self.used[key] -= size
+            if not self.used[key]:
+                del self.used[key]
+
+class Fetcher:
+    """
+    Downloads media for commands, over one shared aiohttp session so connections get reused.
+
+    Every request has a timeout, and downloads are streamed in chunks and abandoned as soon as they pass
+    max_bytes, or straight away if the server says up front that they're going to.
+    """
+    def __init__(self, max_bytes=25*1024*1024, timeout=30, connect_timeout=10, connections=20, chunk_size=64*1024, spool_bytes=1024*1024):
+        self.max_bytes = max_bytes
+        self.spool_bytes = spool_bytes
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.connections = connections
+        self.chunk_size = chunk_size
+        self.session = None
+
+    async def start(self):
+        if self.session is None:
+            import aiohttp
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections, limit_per_host=self.connections//2 or 1),
+                timeout=aiohttp.ClientTimeout(total=self.timeout, sock_connect=self.connect_timeout),
+                headers={"User-Agent": USER_AGENT},
+                raise_for_status=True
+            )
+
+    async def stop(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def stream(self, url, max_bytes=None):
+        """
+        Yields the body of url in chunks, raising TooLarge once it's gone past max_bytes.
+        """
+        import aiohttp
+
+        await self.start()
+        max_bytes = max_bytes or self.max_bytes
+        try:
+            async with self.session.get(url) as response:
+                if response.content_length is not None and response.content_length > max_bytes:
+                    raise TooLarge("%s is %d bytes, more than the limit of %d" % (url, response.content_length, max_bytes))
+
+                received = 0
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    received += len(chunk)
+                    if received > max_bytes:
+                        raise TooLarge("%s is more than the limit of %d bytes" % (url, max_bytes))
+                    yield chunk
+        except aiohttp.ClientError as e:
+            raise FetchError("Unable to fetch %s: %s" % (url, e)) from e
+        except asyncio.TimeoutError as e:
+            raise FetchError("Timed out fetching %s" % url) from e
+
+    async def read(self, url, max_bytes=None):
+        """
+        The whole body of url, as bytes.
+        """
+        chunks = []
+        async for chunk in self.stream(url, max_bytes):
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    async def spool(self, url, max_bytes=None):
+        """
+        Downloads url into a file that only stays in memory while it's small, and moves onto disk after
+        that. Returns the file, rewound to the start, which the caller is responsible for closing.
+
+        Either way it's a real file object, which discord.File can upload directly, and anything written to
+        disk is written from the executor so the event loop isn't held up.
+        """
+        loop = asyncio.get_running_loop()
+        spooled = io.BytesIO()
+        try:
+            async for chunk in self.stream(url, max_bytes):
+                if isinstance(spooled, io.BytesIO) and spooled.tell() + len(chunk) > self.spool_bytes:
+                    spooled = await loop.run_in_executor(None, self.roll_over, spooled)
+                if isinstance(spooled, io.BytesIO):
+                    spooled.write(chunk)
+                else:
+                    await loop.run_in_executor(None, spooled.write, chunk)
+            spooled.seek(0)
+        except BaseException:
+            spooled.close()
+            raise
+        return spooled
+
+    @staticmethod
+    def roll_over(buffer):
+        spooled = tempfile.TemporaryFile()
+        try:
+            spooled.write(buffer.getbuffer())
+        except BaseException:
+            spooled.close()
+            raise
+        buffer.close()
+        return spooled
@@ -0,0 +1,314 @@
+#!/usr/bin/python3
+"""
+Offline load test for the command pipeline.
+
+Drives synthetic traffic through Bot.on_message -> runCommand -> handlers, using stand-in guilds,
+channels, messages and voice clients, and a fake HTTP layer that only sleeps for a simulated round trip.
+Nothing connects to Discord. Reports throughput, latency percentiles and event loop lag.
+
+Usage:
+    python src/loadsim.py [--guilds N] [--messages N] [--rate PER_SECOND] [--latency MS] [--mix roll=5,id=1,...] [--seed N] [--json]
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import itertools
+
+from types import SimpleNamespace
+from collections import Counter, defaultdict
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MIX = {
+    "roll 1d20+5 to hit": 20,
+    "roll 4d6dl1, 4d6dl1, 4d6dl1, 4d6dl1, 4d6dl1, 4d6dl1": 5,
+    "r 8d6 fireball": 10,
+    "id": 5,
+    "sayhi": 5,
+    "bubbles": 2,
+    "help": 3,
+    "help roll": 3,
+    "queue": 5,
+    "suggestions": 2,
+    "suggest Load test suggestion\nPlease ignore": 1,
+    "config": 2,
+    "notacommand": 5,
+    "rip": 5,
+    "just chatting": 30,
+}
+
+ids = itertools.count(10**17)
+
+class FakeHTTP:
+    """
+    Stands in for Discord's REST API. Every request just waits out a simulated round trip.
+    """
+    def __init__(self, latency=0.05, jitter=0.5, rng=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+        self.requests = Counter()
+
+    async def request(self, route):
+        self.requests[route] += 1
+        await asyncio.sleep(self.latency * (1 + self.jitter*(self.rng.random()-0.5)))
+
+class FakeUser:
+    def __init__(self, name, bot=False):
+        self.id = next(ids)
+        self.name = name
+        self.display_name = name
+        self.mention = "<@%d>" % self.id
+        self.bot = bot
+        self.voice = None
+        self.roles = []
+        self.avatar = self.display_avatar = SimpleNamespace(url="https://cdn.example/avatar.png")
+        self.avatar_url = self.avatar.url
+        self.guild_permissions = SimpleNamespace(administrator=False)
+
+    def __str__(self):
+        return self.name
+
+class FakeTyping:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def __aenter__(self):
+        await self.channel.http.request("typing")
+
+    async def __aexit__(self, *args):
+        pass
+
+class FakeChannel:
+    def __init__(self, http, guild, name):
+        self.id = next(ids)
+        self.http = http
+        self.guild = guild
+        self.name = name
+        self.members = []
+
+    def __str__(self):
+        return self.name
+
+    def typing(self):
+        return FakeTyping(self)
+
+    async def trigger_typing(self):
+        await self.http.request("typing")
+
+    async def send(self, content=None, files=None, embed=None, **kwargs):
+        await self.http.request("send")
+        return FakeMessage(self, self.guild.me if self.guild else None, content or "")
+
+    def permissions_for(self, member):
+        return member.guild_permissions
+
+class FakeVoiceClient:
+    def __init__(self, channel):
+        self.channel = channel
+        self.source = None
+        self.playing = False
+        self.paused = False
+
+    def is_playing(self):
+        return self.playing
+
+    def is_paused(self):
+        return self.paused
+
+    def stop(self):
+        self.playing = False
+
+    async def disconnect(self):
+        self.channel.guild.voice_client = None
+
+class FakeGuild:
+    def __init__(self, http, name, channels=2, members=20):
+        self.id = next(ids)
+        self.name = name
+        self.me = FakeUser("Sputnik", bot=True)
+        self.text_channels = [FakeChannel(http, self, "channel-%d" % i) for i in range(channels)]
+        self.members = [FakeUser("%s-user-%d" % (name, i)) for i in range(members)]
+        self.voice_client = None
+        self.owner_id = self.members[0].id
+
+    def __str__(self):
+        return self.name
+
+    def get_channel(self, id):
+        return next((channel for channel in self.text_channels if channel.id == id), None)
+
+class FakeMessage:
+    def __init__(self, channel, author, content):
+        self.id = next(ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.mentions = []
+        self.role_mentions = []
+        self.mention_everyone = False
+        self.attachments = []
+        self.embeds = []
+
+    async def delete(self):
+        await self.channel.http.request("delete")
+
+def make_bot(http, guilds):
+    """
+    Builds a real Bot around the fakes, without logging in.
+    """
+    import bot
+    from config import Config
+
+    class SimBot(bot.Bot):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.latencies = defaultdict(list)
+            self.pending = set()
+            self.owner = FakeUser("owner")
+
+        async def wait_until_ready(self):
+            # Nothing connects to Discord, so there's no READY to wait for
+            pass
+
+        async def application_info(self):
+            await http.request("application_info")
+            return SimpleNamespace(team=None, owner=self.owner)
+
+        async def runCommand(self, command, handler, message):
+            start = time.perf_counter()
+            self.pending.add(asyncio.current_task())
+            try:
+                await super().runCommand(command, handler, message)
+            finally:
+                self.latencies[command].append(time.perf_counter() - start)
+                self.pending.discard(asyncio.current_task())
+
+    config = Config()
+    config.configDict[0].set("Metrics", "Port", "0")
+    config.server_setup(guilds)
+
+    sim = SimBot(config)
+    return sim
+
+async def simulate(guild_count=50, messages=2000, rate=200, latency=0.05, mix=None, seed=0):
+    import player
+    from suggestions import SuggestionList
+    from faketrello import FakeTrelloClient
+
+    rng = random.Random(seed)
+    random.seed(seed)
+    http = FakeHTTP(latency=latency, rng=random.Random(seed+1))
+    guilds = [FakeGuild(http, "guild-%d" % i) for i in range(guild_count)]
+    mix = mix or DEFAULT_MIX
+
+    sim = make_bot(http, guilds)
+    # Entering the client sets it up on this loop, and setup_hook is what logging in would run next
+    async with sim:
+        await sim.setup_hook()
+        sim.watchdog.interval = 0.01
+        trello = FakeTrelloClient(latency=latency, seed=seed)
+        sim.suggestions = SuggestionList(trello, trello.lists[0]['id'])
+        sim.suggestions.start()
+        for guild in guilds:
+            sim.players[guild.id] = player.Player(sim, guild)
+
+        prefix = sim.config.get("default", "Server", "CommandPrefix")
+        texts = list(mix.keys())
+        weights = list(mix.values())
+
+        dispatched = set()
+        start = time.perf_counter()
+        for i in range(messages):
+            guild = rng.choice(guilds)
+            channel = rng.choice(guild.text_channels)
+            text = rng.choices(texts, weights)[0]
+            if text not in ("rip", "just chatting"):
+                text = prefix + text
+            message = FakeMessage(channel, rng.choice(guild.members), text)
+
+            # Like discord.py, every event gets its own task
+            task = asyncio.create_task(sim.on_message(message))
+            dispatched.add(task)
+            task.add_done_callback(dispatched.discard)
+
+            await asyncio.sleep(rng.expovariate(rate))
+
+        # Wait for the dispatched events, then for the commands they spawned
+        await asyncio.sleep(0.01)
+        while dispatched or sim.pending:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+
+        lag = sim.watchdog.percentiles((0.5, 0.99))
+
+    all_latencies = sorted(itertools.chain.from_iterable(sim.latencies.values()))
+    return {
+        "guilds": guild_count,
+        "messages": messages,
+        "commands": len(all_latencies),
+        "seconds": elapsed,
+        "throughput": len(all_latencies)/elapsed,
+        "p50": percentile(all_latencies, 0.5),
+        "p99": percentile(all_latencies, 0.99),
+        "loop_lag_p50": lag[0.5],
+        "loop_lag_p99": lag[0.99],
+        "http_requests": dict(http.requests),
+        "per_command": {
+            command: {"count": len(times), "p50": percentile(sorted(times), 0.5), "p99": percentile(sorted(times), 0.99)}
+            for command, times in sorted(sim.latencies.items())
+        },
+    }
+
+def percentile(values, q):
+    if not values:
+        return None
+    return values[min(len(values)-1, int(q*len(values)))]
+
+def report(results):
+    def ms(seconds):
+        return "-" if seconds is None else "%.1fms" % (seconds*1000)
+
+    print("%d commands from %d messages across %d guilds in %.2fs" % (results["commands"], results["messages"], results["guilds"], results["seconds"]))
+    print("Throughput: %.1f commands/s" % results["throughput"])
+    print("Latency p50/p99: %s / %s" % (ms(results["p50"]), ms(results["p99"])))
+    print("Loop lag p50/p99: %s / %s" % (ms(results["loop_lag_p50"]), ms(results["loop_lag_p99"])))
+    print("HTTP requests: %s" % ", ".join("%s=%d" % item for item in sorted(results["http_requests"].items())))
+    print()
+    print("%-12s %6s %10s %10s" % ("command", "count", "p50", "p99"))
+    for command, stats in results["per_command"].items():
+        print("%-12s %6d %10s %10s" % (command, stats["count"], ms(stats["p50"]), ms(stats["p99"])))
+
+def parse_mix(text):
+    mix = {}
+    for entry in text.split(","):
+        command, weight = entry.rsplit("=", 1)
+        mix[command.strip()] = float(weight)
+    return mix
+
+if __name__ == "__main__":
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__))+"/..")
+
+    parser = argparse.ArgumentParser(description="Offline load test for Sputnik's command pipeline")
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=200, help="messages per second")
+    parser.add_argument("--latency", type=float, default=50, help="simulated Discord round trip, in ms")
+    parser.add_argument("--mix", type=parse_mix, default=None, help="command=weight pairs, separated by commas")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    results = asyncio.run(simulate(args.guilds, args.messages, args.rate, args.latency/1000, args.mix, args.seed))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
@@ -0,0 +1,132 @@
+import os
+import sys
+import copy
+import time
+import gzip
+import json
+import queue
+import atexit
+import shutil
+import logging
+import logging.handlers
+
+log = logging.getLogger(__name__)
+
+LOG_DIR = "logs/"
+LOG_FILE = "sputnik.log"
+
+FORMAT = "%(asctime)s - %(levelname)s:%(name)s:%(message)s"
+
+listener = None
+
+class JsonFormatter(logging.Formatter):
+    """
+    Writes each record as a single JSON object per line, for anything that wants to parse the logs.
+    """
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "name": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+class TracebackQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler that keeps the traceback apart from the message. The stock one folds it into the message
+    and drops the exception, which leaves JsonFormatter nothing to put in its exception field.
+    """
+    def prepare(self, record):
+        # The exception itself can hold on to frames that aren't safe to pass between threads, so it goes as text
+        exception = record.exc_text
+        if record.exc_info and not exception:
+            exception = logging.Formatter().formatException(record.exc_info)
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exception
+        return record
+
+class ArchivingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotates the log once it grows past max_bytes, or once it's been open for longer than max_age seconds.
+    Rotated logs are gzipped on the way out if compress is set.
+    """
+    def __init__(self, filename, max_bytes=0, max_age=0, backup_count=5, compress=True):
+        super().__init__(filename, mode='a', maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.max_age = max_age
+        self.rollover_at = (time.time() + max_age) if max_age else None
+
+        if compress:
+            self.namer = lambda name: name + ".gz"
+            self.rotator = compress_log
+
+    def shouldRollover(self, record):
+        if self.rollover_at and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.max_age:
+            self.rollover_at = time.time() + self.max_age
+
+def compress_log(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+def archive_name(index=1):
+    """
+    Name of the index'th most recent rotated log, whether or not it was compressed.
+    """
+    path = os.path.join(LOG_DIR, "%s.%d" % (LOG_FILE, index))
+    if os.path.isfile(path + ".gz"):
+        return path + ".gz"
+    return path
+
+def setup(level="DEBUG", max_bytes=0, max_age=0, backup_count=5, compress=True, json_lines=False):
+    """
+    Route all logging through a queue, so that the only work done on the calling thread is an enqueue.
+    The console and log file handlers are run by a listener on its own background thread.
+    """
+    global listener
+
+    logfile = ArchivingFileHandler(
+        os.path.join(LOG_DIR, LOG_FILE),
+        max_bytes=max_bytes,
+        max_age=max_age,
+        backup_count=backup_count,
+        compress=compress
+    )
+    # Start every run with a fresh log, keeping the last one around as an archive
+    if logfile.stream.tell() > 0:
+        logfile.doRollover()
+    logfile.setFormatter(JsonFormatter() if json_lines else logging.Formatter(fmt=FORMAT))
+
+    console = logging.StreamHandler(sys.stderr)
+    console.setFormatter(logging.Formatter(fmt=logging.BASIC_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, console, logfile, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(TracebackQueueHandler(log_queue))
+
+def stop():
+    """
+    Flush anything still in the queue and shut down the writer thread.
+    """
+    global listener
+    if listener:
+        listener.stop()
+        listener = None
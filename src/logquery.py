@@ -0,0 +1,275 @@
+import os
+import re
+import gzip
+import time
+import hashlib
+import logging
+
+from collections import deque
+
+import logfile
+
+log = logging.getLogger(__name__)
+
+INDEX_DIR = ".index"
+BLOCK_SIZE = 64*1024
+
+LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+
+TEXT_RECORD = re.compile(rb'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),\d{3} - (\w+):')
+JSON_RECORD = re.compile(rb'^\{"time": "(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),\d{3}", "level": "(\w+)"')
+
+DURATION = re.compile(r'^(\d+)([smhdw]?)$')
+UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+def parse_header(line):
+    """
+    Returns the (timestamp, level bit) of a line that starts a new log record, or None for continuation lines.
+    Levels we don't recognise all share the bit after CRITICAL.
+    """
+    match = TEXT_RECORD.match(line) or JSON_RECORD.match(line)
+    if not match:
+        return None
+    timestamp = time.mktime(time.strptime(match.group(1).decode(), "%Y-%m-%d %H:%M:%S"))
+    level = match.group(2).decode()
+    return timestamp, 1 << (LEVELS.index(level) if level in LEVELS else len(LEVELS))
+
+def parse_duration(text):
+    match = DURATION.match(text.strip().lower())
+    if not match:
+        raise ValueError("Invalid duration: %s" % text)
+    return int(match.group(1)) * UNITS[match.group(2)]
+
+def open_log(path):
+    return gzip.open(path, 'rb') if path.endswith(".gz") else open(path, 'rb')
+
+def log_files():
+    """
+    Every log file still on disk, oldest archive first and the current log last.
+    """
+    archives = []
+    for name in os.listdir(logfile.LOG_DIR):
+        match = re.match(re.escape(logfile.LOG_FILE) + r'\.(\d+)(\.gz)?$', name)
+        if match:
+            archives.append((int(match.group(1)), os.path.join(logfile.LOG_DIR, name)))
+    files = [path for number, path in sorted(archives, reverse=True)]
+    current = os.path.join(logfile.LOG_DIR, logfile.LOG_FILE)
+    if os.path.isfile(current):
+        files.append(current)
+    return files
+
+def tail(path, max_bytes, block_size=8192):
+    """
+    Returns the last complete lines of a file that fit within max_bytes, reading backwards from the end
+    so that only the tail of the file is ever loaded.
+    """
+    with open(path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        data = b''
+        while position > 0 and len(data) <= max_bytes:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+
+    lines = data.splitlines(keepends=True)
+    # The first line is likely to be cut off, unless we read all the way back to the start of the file
+    if position > 0 and lines:
+        lines.pop(0)
+
+    out = deque()
+    size = 0
+    for line in reversed(lines):
+        if size + len(line) > max_bytes:
+            break
+        out.appendleft(line.decode(errors='replace'))
+        size += len(line)
+    return list(out)
+
+class LogIndex:
+    """
+    A sidecar index of a log file, recording the byte range, time range and levels present in
+    each ~64KB block of records, so that queries can skip straight past blocks that can't match.
+
+    Indexes are named after the first line of the log they cover, so they stay valid when the log
+    is rotated and compressed; offsets are always into the uncompressed log.
+
+    Archives never change, so once one has been indexed to the end its index is marked complete, and
+    it never needs decompressing again just to check for anything new.
+    """
+    def __init__(self, path, archived=False):
+        self.path = path
+        self.archived = archived
+        self.blocks = []    # (start, end, first_time, last_time, levels)
+        self.complete = False
+        self.signature = None
+        self.dirty = False
+
+        with open_log(path) as f:
+            first = f.readline()
+        if first.endswith(b'\n'):
+            self.signature = hashlib.md5(first).hexdigest()
+            self.load()
+
+    @property
+    def index_path(self):
+        return os.path.join(os.path.dirname(self.path), INDEX_DIR, self.signature + ".idx")
+
+    @property
+    def end(self):
+        return self.blocks[-1][1] if self.blocks else 0
+
+    def load(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    if line.strip() == "complete":
+                        self.complete = True
+                        continue
+                    start, end, first_time, last_time, levels = line.split()
+                    self.blocks.append((int(start), int(end), float(first_time), float(last_time), int(levels)))
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            log.warning("Discarding corrupt log index for %s", self.path)
+            self.blocks = []
+            self.complete = False
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty or not self.signature:
+            return
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        with open(self.index_path, 'w') as f:
+            for block in self.blocks:
+                f.write("%d %d %.0f %.0f %d\n" % block)
+            if self.complete:
+                f.write("complete\n")
+        self.dirty = False
+
+    def update(self):
+        """
+        Index any complete blocks written since the last update. For an archive, index everything to
+        the end, including the last partial block.
+        """
+        if not self.signature or self.complete:
+            return
+
+        with open_log(self.path) as f:
+            f.seek(self.end)
+            start = position = self.end
+            last_time = self.blocks[-1][3] if self.blocks else 0
+            first_time = None
+            levels = 0
+
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                header = parse_header(line)
+                if header:
+                    # Only ever split blocks between records, so that tracebacks stay with their record
+                    if position - start >= BLOCK_SIZE:
+                        self.blocks.append((start, position, first_time or last_time, last_time, levels))
+                        self.dirty = True
+                        start = position
+                        first_time = None
+                        levels = 0
+                    if first_time is None:
+                        first_time = header[0]
+                    last_time = header[0]
+                    levels |= header[1]
+                elif not levels:
+                    # Continuation of a record from the previous block
+                    levels = 1 << len(LEVELS)
+                position += len(line)
+
+        if self.archived:
+            if position > start:
+                self.blocks.append((start, position, first_time or last_time, last_time, levels))
+            self.complete = True
+            self.dirty = True
+        self.save()
+
+    def records(self, f, start, end=None):
+        """
+        Yields (timestamp, level bit, text) for every record between the given offsets.
+        """
+        f.seek(start)
+        position = start
+        record = []
+        header = (0, 1 << len(LEVELS))
+        for line in f:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            parsed = parse_header(line)
+            if parsed:
+                if record:
+                    yield header[0], header[1], b''.join(record).decode(errors='replace')
+                record = []
+                header = parsed
+            record.append(line)
+        if record:
+            yield header[0], header[1], b''.join(record).decode(errors='replace')
+
+def query(level=None, since=None, grep=None, limit=50):
+    """
+    Search every log file, current and archived, for records at or above the given level,
+    newer than since (in seconds), and matching the grep regex.
+    Returns the newest matching records, up to limit, along with the total count of matches.
+    """
+    mask = 0
+    for bit in range(LEVELS.index(level.upper()) if level else 0, len(LEVELS)):
+        mask |= 1 << bit
+    if not level:
+        mask |= 1 << len(LEVELS)    # Unrecognised levels are only matched by unfiltered queries
+    cutoff = time.time() - since if since else None
+    pattern = re.compile(grep, re.IGNORECASE) if grep else None
+
+    matches = deque(maxlen=limit)
+    total = 0
+    signatures = set()
+
+    current = os.path.join(logfile.LOG_DIR, logfile.LOG_FILE)
+    for path in log_files():
+        index = LogIndex(path, archived=path != current)
+        if not index.signature:
+            continue
+        index.update()
+        signatures.add(index.signature)
+
+        ranges = [
+            (start, end) for start, end, first_time, last_time, levels in index.blocks
+            if (levels & mask) and (cutoff is None or last_time >= cutoff)
+        ]
+        if not index.complete:
+            # Anything past the last complete block hasn't been indexed yet, and always needs a look
+            ranges.append((index.end, None))
+        if not ranges:
+            continue
+
+        with open_log(path) as f:
+            for start, end in ranges:
+                for timestamp, bit, text in index.records(f, start, end):
+                    if cutoff is not None and timestamp < cutoff:
+                        continue
+                    if not (bit & mask):
+                        continue
+                    if pattern and not pattern.search(text):
+                        continue
+                    matches.append(text)
+                    total += 1
+
+    prune(signatures)
+    return list(matches), total
+
+def prune(signatures):
+    """
+    Remove indexes for logs that have since been rotated out and deleted.
+    """
+    index_dir = os.path.join(logfile.LOG_DIR, INDEX_DIR)
+    if not os.path.isdir(index_dir):
+        return
+    for name in os.listdir(index_dir):
+        if name.endswith(".idx") and name[:-4] not in signatures:
+            os.remove(os.path.join(index_dir, name))
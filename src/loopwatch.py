@@ -0,0 +1,85 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+
+from collections import deque
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+LOOP_LAG = metrics.Histogram(
+    "sputnik_loop_lag_seconds", "Delay between scheduling a callback on the event loop and it running",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+LOOP_STALLS = metrics.Counter("sputnik_loop_stalls_total", "Times the event loop was blocked past the stall threshold")
+
+class Watchdog(threading.Thread):
+    """
+    Keeps poking the event loop from a background thread, measuring how long it takes to respond.
+    If the loop doesn't respond within the threshold, something is blocking it, so we grab the loop
+    thread's stack and whatever command was running, and log them.
+
+    Must be started from the event loop's own thread, so it knows which thread to look at.
+    """
+    def __init__(self, loop, interval=0.5, threshold=1.0, describe=None, samples=1000):
+        super().__init__(name="watchdog", daemon=True)
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.describe = describe
+        self.samples = deque(maxlen=samples)
+        self.loop_thread = threading.get_ident()
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            responded = threading.Event()
+            sent = time.perf_counter()
+            try:
+                self.loop.call_soon_threadsafe(responded.set)
+            except RuntimeError:
+                # Loop's been closed out from under us
+                return
+
+            if not responded.wait(self.threshold):
+                self.report_stall()
+                while not responded.wait(self.interval):
+                    if self.stopped.is_set():
+                        return
+                log.warning("Event loop was blocked for %.2fs", time.perf_counter() - sent)
+
+            lag = time.perf_counter() - sent
+            self.samples.append(lag)
+            LOOP_LAG.observe(lag)
+
+            self.stopped.wait(self.interval)
+
+    def report_stall(self):
+        LOOP_STALLS.inc()
+
+        frame = sys._current_frames().get(self.loop_thread)
+        stack = "".join(traceback.format_stack(frame)) if frame else "(unavailable)\n"
+
+        task = asyncio.current_task(self.loop)
+        running = self.describe(task) if (self.describe and task) else None
+
+        log.warning(
+            "Event loop has been blocked for over %.2fs%s. Loop thread is at:\n%s",
+            self.threshold, (" while running %s" % running) if running else "", stack.rstrip()
+        )
+
+    def percentiles(self, quantiles=(0.5, 0.9, 0.99)):
+        """
+        Loop lag at each of the given quantiles, over the most recent samples.
+        """
+        samples = sorted(self.samples)
+        if not samples:
+            return {q: None for q in quantiles}
+        return {q: samples[min(len(samples)-1, int(q*len(samples)))] for q in quantiles}
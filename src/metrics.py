@@ -0,0 +1,244 @@
+import time
+import logging
+import threading
+
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Metric:
+    """
+    A named family of values, one per combination of label values, rendered in the Prometheus text format.
+    """
+    type = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def label_string(self, key, extra=None):
+        pairs = list(zip(self.labels, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs)
+
+    def collect(self):
+        with self.lock:
+            return dict(self.values)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s %s" % (self.name, self.type)]
+        for key, value in sorted(self.collect().items()):
+            lines.append("%s%s %s" % (self.name, self.label_string(key), format_value(value)))
+        return lines
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """
+    A value that can go up and down. If given a callback, it's asked for {labels tuple: value} whenever collected,
+    so things like queue lengths are measured at scrape time rather than tracked on every change.
+    """
+    type = "gauge"
+
+    def __init__(self, name, description, labels=(), callback=None):
+        super().__init__(name, description, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def collect(self):
+        if self.callback:
+            try:
+                return dict(self.callback())
+            except Exception:
+                log.exception("Unable to collect %s", self.name)
+                return {}
+        return super().collect()
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0]*len(self.buckets), 0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+                    break
+            counts[1] += 1
+            counts[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self):
+        with self.lock:
+            return {key: (list(buckets), count, total) for key, (buckets, count, total) in self.values.items()}
+
+    def quantile(self, q, **labels):
+        """
+        Estimate a quantile by interpolating within the bucket it falls in, like Prometheus' histogram_quantile.
+        """
+        with self.lock:
+            counts = self.values.get(self.key(labels))
+            if not counts or not counts[1]:
+                return None
+            buckets, count = list(counts[0]), counts[1]
+        return estimate_quantile(self.buckets, buckets, count, q)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s %s" % (self.name, self.type)]
+        for key, (buckets, count, total) in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, buckets):
+                cumulative += bucket
+                lines.append("%s_bucket%s %d" % (self.name, self.label_string(key, ("le", format_value(bound))), cumulative))
+            lines.append("%s_bucket%s %d" % (self.name, self.label_string(key, ("le", "+Inf")), count))
+            lines.append("%s_sum%s %s" % (self.name, self.label_string(key), format_value(total)))
+            lines.append("%s_count%s %d" % (self.name, self.label_string(key), count))
+        return lines
+
+class CountingExecutor(ThreadPoolExecutor):
+    """
+    A ThreadPoolExecutor that counts the jobs waiting for a thread as they're submitted and started, so
+    their number can be reported without looking inside its queue.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        self.waiting = 0
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self.lock:
+            self.waiting += 1
+        try:
+            future = super().submit(self.started, fn, args, kwargs)
+        except BaseException:
+            with self.lock:
+                self.waiting -= 1
+            raise
+        # Cancelled jobs never start, so they have to stop counting here instead
+        future.add_done_callback(self.cancelled)
+        return future
+
+    def started(self, fn, args, kwargs):
+        with self.lock:
+            self.waiting -= 1
+        return fn(*args, **kwargs)
+
+    def cancelled(self, future):
+        if future.cancelled():
+            with self.lock:
+                self.waiting -= 1
+
+def estimate_quantile(bounds, buckets, count, q):
+    target = q * count
+    cumulative = 0
+    lower = 0
+    for bound, bucket in zip(bounds, buckets):
+        if bucket and cumulative + bucket >= target:
+            return lower + (bound - lower) * (target - cumulative) / bucket
+        cumulative += bucket
+        lower = bound
+    # Past the last bucket; the best we can say is that it's bigger than that
+    return bounds[-1]
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value) if value != int(value) else str(int(value))
+    return str(value)
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def cache_hit_rates():
+    """
+    Returns {cache name: (hits, misses)} for every cache that's reported to CACHE_REQUESTS.
+    """
+    rates = {}
+    for (cache, result), count in CACHE_REQUESTS.collect().items():
+        hits, misses = rates.get(cache, (0, 0))
+        rates[cache] = (hits + count, misses) if result == "hit" else (hits, misses + count)
+    return rates
+
+registry = []
+
+COMMANDS = Counter("sputnik_commands_total", "Commands run, by command and outcome", ["command", "result"])
+COMMAND_LATENCY = Histogram("sputnik_command_seconds", "Time taken to run and reply to commands", ["command"])
+YTDL_EXTRACT = Histogram("sputnik_ytdl_extract_seconds", "Time taken by yt_dlp to extract song info")
+YTDL_DOWNLOAD = Histogram("sputnik_ytdl_download_seconds", "Time taken by yt_dlp to download songs", buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+EXECUTOR_QUEUE = Gauge("sputnik_executor_queue_depth", "Jobs waiting on an executor", ["executor"])
+VOICE_SESSIONS = Gauge("sputnik_voice_sessions", "Voice channels currently connected to")
+QUEUED_SONGS = Gauge("sputnik_queued_songs", "Songs waiting in playlists, across all guilds")
+CACHE_REQUESTS = Counter("sputnik_cache_requests_total", "Cache lookups, by cache and whether they hit", ["cache", "result"])
+OCR_JOBS = Counter("sputnik_ocr_jobs_total", "OCR jobs, by outcome", ["result"])
+OCR_SECONDS = Histogram("sputnik_ocr_seconds", "Time taken to read an image, once it's a job's turn")
+OCR_WAIT = Histogram("sputnik_ocr_wait_seconds", "Time OCR jobs spent queued")
+OCR_WORKERS_REPLACED = Counter("sputnik_ocr_workers_replaced_total", "OCR worker processes replaced, by reason", ["reason"])
+
+class MetricsServer:
+    """
+    Serves the registry in the Prometheus text format over HTTP.
+    Only meant to be bound to localhost, for a local scraper to pick up.
+    """
+    def __init__(self, host="127.0.0.1", port=9100):
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def start(self):
+        # The server half of aiohttp isn't otherwise needed, so only load it if metrics are being served
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        log.info("Serving metrics on http://%s:%d/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle(self, request):
+        from aiohttp import web
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
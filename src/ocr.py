@@ -0,0 +1,458 @@
+import io
+import os
+import sys
+import time
+import socket
+import asyncio
+import logging
+import subprocess
+
+from multiprocessing.connection import Connection
+
+from collections import OrderedDict, deque
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# What worker processes run. It only imports what reading needs, so they don't load the rest of the bot
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ocrworker.py")
+
+# Most sets of languages a worker keeps loaded at once. Each set loads its own copy of every model in it,
+# so keeping one for every language we might detect would load the first language over and over
+MAX_LANGUAGE_SETS = 2
+
+class OcrError(Exception):
+    pass
+
+class QueueFull(OcrError):
+    pass
+
+class JobTimeout(OcrError):
+    pass
+
+class JobCancelled(OcrError):
+    pass
+
+class Engine:
+    """
+    Reads images inside a worker process, keeping the language models loaded between jobs.
+
+    Uses tesserocr, which talks to the Tesseract library directly, if it's installed. Otherwise falls back
+    to pytesseract, which still has to start tesseract for every image.
+
+    Images are cleaned up first (see preprocess). Given more than one language, the image is read in just
+    the first, and only read again with another added if the text looks like it's in that one instead.
+    """
+    def __init__(self, lang, options=None):
+        self.lang = lang
+        self.options = options or {}
+        self.apis = OrderedDict()
+        self.tesserocr = None
+        try:
+            import tesserocr
+            self.tesserocr = tesserocr
+            self.api(self.first_languages())
+        except ImportError:
+            pass
+        except RuntimeError as e:
+            sys.stderr.write("Unable to load tesserocr, falling back to pytesseract: %s\n" % e)
+            self.tesserocr = None
+        self.name = "tesserocr" if self.tesserocr else "pytesseract"
+
+    def first_languages(self):
+        # What every image is read in first, so it's loaded up front
+        return self.lang.split("+")[0] if self.options.get("detect_language") else self.lang
+
+    def api(self, lang):
+        # Kept for the sets of languages used most recently, so switching between them doesn't usually mean
+        # loading models again
+        if lang in self.apis:
+            self.apis.move_to_end(lang)
+            return self.apis[lang]
+        while len(self.apis) >= MAX_LANGUAGE_SETS:
+            self.apis.popitem(last=False)[1].End()
+        self.apis[lang] = self.tesserocr.PyTessBaseAPI(lang=lang)
+        return self.apis[lang]
+
+    def recognize(self, picture, lang, timeout):
+        if self.tesserocr:
+            api = self.api(lang)
+            api.SetImage(picture)
+            return api.GetUTF8Text()
+
+        import pytesseract
+        # pytesseract kills tesseract if it runs past the timeout, which we'd otherwise leave running
+        return pytesseract.image_to_string(picture, lang=lang, timeout=timeout)
+
+    def read(self, image, lang, timeout, tile_height=None):
+        """
+        Reads image, or if it's more than a tile tall, splits it into tiles to be read separately. Returns
+        ("ok", text) or ("tiles", [tile, ...]), where each tile is a (size, pixels) pair for read_tile.
+        """
+        import preprocess
+
+        picture = preprocess.load(image, max_side=self.options.get("max_side", 2000))
+        picture = preprocess.clean(picture, threshold=self.options.get("binarize", True), deskew=self.options.get("deskew", True))
+
+        if tile_height and picture.height > tile_height*1.5:
+            tiles = [picture.crop((0, top, picture.width, bottom)) for top, bottom in preprocess.bands(picture, tile_height)]
+            if len(tiles) > 1:
+                return "tiles", [(tile.size, tile.tobytes()) for tile in tiles]
+
+        return "ok", self.recognize_detecting(picture, lang, timeout)
+
+    def read_tile(self, tile, lang, timeout):
+        from PIL import Image
+        size, pixels = tile
+        return "ok", self.recognize_detecting(Image.frombytes("L", size, pixels), lang, timeout)
+
+    def recognize_detecting(self, picture, lang, timeout):
+        import preprocess
+
+        languages = lang.split("+")
+        if not self.options.get("detect_language") or len(languages) == 1:
+            return self.recognize(picture, lang, timeout)
+
+        text = self.recognize(picture, languages[0], timeout)
+        detected = preprocess.detect_language(text, languages)
+        if detected == languages[0]:
+            return text
+        return self.recognize(picture, languages[0] + "+" + detected, timeout)
+
+def serve(connection, lang, options=None):
+    """
+    The main loop of a worker process. Answers ("read", image, lang, timeout, tile_height),
+    ("read_tile", tile, lang, timeout) and ("ping",) messages until the pipe is closed.
+    """
+    engine = Engine(lang, options)
+    connection.send(("ready", engine.name))
+    while True:
+        try:
+            message = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if message[0] == "ping":
+            connection.send(("pong", engine.name))
+        elif message[0] in ("read", "read_tile"):
+            try:
+                connection.send(getattr(engine, message[0])(*message[1:]))
+            except Exception as e:
+                connection.send(("error", "%s: %s" % (type(e).__name__, e)))
+
+class Worker:
+    """
+    Our end of a worker process. The blocking calls here are run off the event loop.
+
+    Workers start from a fresh interpreter running WORKER_SCRIPT, rather than a fork of the bot and all its
+    threads, and talk to us over a socket pair. Being a separate script means they don't import bot.py the
+    way multiprocessing's spawned children import the main module.
+    """
+    def __init__(self, lang, options=None):
+        ours, theirs = socket.socketpair()
+        try:
+            self.process = subprocess.Popen([sys.executable, WORKER_SCRIPT, str(theirs.fileno())], pass_fds=(theirs.fileno(),))
+        except BaseException:
+            ours.close()
+            raise
+        finally:
+            theirs.close()
+        self.connection = Connection(ours.detach())
+        self.connection.send((lang, options))
+        self.jobs = 0
+        self.engine = None
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def call(self, message, timeout):
+        self.connection.send(message)
+        return self.receive(timeout)
+
+    def receive(self, timeout):
+        if not self.connection.poll(timeout):
+            raise JobTimeout("No answer from the OCR worker after %ss" % timeout)
+        return self.connection.recv()
+
+    def kill(self):
+        # Anything waiting on the connection will get an EOFError
+        if self.alive():
+            self.process.kill()
+
+    def retire(self):
+        self.kill()
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            log.warning("OCR worker %d didn't exit after being killed", self.pid)
+        self.connection.close()
+
+class Job:
+    def __init__(self, key, guild, request):
+        self.key = key
+        self.guild = guild
+        self.request = request
+        self.future = asyncio.get_running_loop().create_future()
+        self.submitted = time.monotonic()
+        self.worker = None
+
+class OcrScheduler:
+    """
+    Runs OCR jobs on a pool of long-lived worker processes, each with the language models already loaded.
+
+    Jobs are queued per guild and taken from each guild in turn, so one busy server can't starve the rest.
+    The queue is bounded, and jobs can be cancelled by key (the id of the message that asked for them)
+    whether they're still queued or already running.
+
+    Images taller than tile_height are split at gaps between lines of text, and the tiles read in parallel.
+
+    Workers are replaced when they run past a job's timeout, crash, fail a health check while idle, or
+    have read max_jobs images, so a leak in Tesseract can't build up forever.
+    """
+    def __init__(self, workers=2, max_queued=20, timeout=60, lang="eng", max_jobs=200, health_interval=60, options=None, tile_height=1200):
+        self.workers = workers
+        self.tile_height = tile_height
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.lang = lang
+        self.options = options or {}
+        self.max_jobs = max_jobs
+        self.health_interval = health_interval
+
+        self.queues = OrderedDict()     # guild -> deque of Jobs, in the order the guilds take turns
+        self.jobs = {}                  # key -> [Job], queued or running
+        self.running = set()
+        self.wakeup = None
+        self.tasks = []
+
+    def start(self):
+        """
+        Starts the workers loading their models, so they're warm by the time anyone wants something read.
+        """
+        if not self.tasks:
+            self.wakeup = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            self.tasks = [loop.create_task(self.work()) for i in range(self.workers)]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        for jobs in list(self.jobs.values()):
+            for job in list(jobs):
+                self.finish(job, exception=JobCancelled("Shutting down"), result="cancelled")
+
+    def queued(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def order(self):
+        """
+        Queued jobs in the order they'll be run.
+        """
+        queues = list(self.queues.values())
+        for turn in range(max((len(queue) for queue in queues), default=0)):
+            for queue in queues:
+                if turn < len(queue):
+                    yield queue[turn]
+
+    def position(self, key):
+        """
+        How many jobs will run before this one, or None if it isn't waiting.
+        """
+        return next((number for number, job in enumerate(self.order()) if job.key == key), None)
+
+    def busy(self):
+        return len(self.running) >= self.workers
+
+    def submit(self, key, guild, request, bounded=True):
+        self.start()
+        if bounded and self.queued() >= self.max_queued:
+            raise QueueFull("There are already %d images waiting to be read" % self.max_queued)
+
+        job = Job(key, guild, request)
+        self.jobs.setdefault(key, []).append(job)
+        self.queues.setdefault(guild, deque()).append(job)
+        self.wakeup.set()
+        return job
+
+    async def read(self, key, guild, image, lang=None, on_queued=None):
+        """
+        Reads the text in image, waiting its turn. If the job has to wait behind others, on_queued is
+        awaited first with the number of jobs ahead of it.
+        """
+        return "".join([text async for text in self.read_progressively(key, guild, image, lang, on_queued, tiled=False)])
+
+    async def read_progressively(self, key, guild, image, lang=None, on_queued=None, tiled=True):
+        """
+        Like read, but yields the text a tile at a time, in reading order, as soon as each is ready.
+        """
+        lang = lang or self.lang
+        waiting = self.busy() or self.queued() > 0
+        job = self.submit(key, guild, ("read", image, lang, self.timeout, self.tile_height if tiled else None))
+        if waiting and on_queued:
+            await on_queued(self.position(key))
+
+        kind, value = await job.future
+        if kind == "ok":
+            yield value
+            return
+
+        log.info("Reading OCR job %s in %d tiles", key, len(value))
+        # Already let in, so the tiles don't count against the queue limit
+        tiles = [self.submit(key, guild, ("read_tile", tile, lang, self.timeout), bounded=False) for tile in value]
+        try:
+            for tile in tiles:
+                kind, text = await tile.future
+                yield text
+        finally:
+            # If we've stopped early, nobody wants the rest
+            for tile in tiles:
+                if not tile.future.done():
+                    self.drop(tile, JobCancelled("Cancelled"))
+            for tile in tiles:
+                if tile.future.done() and not tile.future.cancelled():
+                    tile.future.exception()
+
+    def cancel(self, key):
+        jobs = list(self.jobs.get(key, ()))
+        if not jobs:
+            return False
+        for job in jobs:
+            self.drop(job, JobCancelled("Cancelled"))
+        log.info("Cancelled OCR job %s", key)
+        return True
+
+    def drop(self, job, exception):
+        queue = self.queues.get(job.guild)
+        if queue and job in queue:
+            queue.remove(job)
+            if not queue:
+                del self.queues[job.guild]
+        self.finish(job, exception=exception, result="cancelled")
+        if job.worker:
+            # Stop it part way, rather than tie up a worker with an image nobody wants anymore
+            job.worker.kill()
+
+    def next_job(self):
+        if not self.queues:
+            return None
+        guild, queue = next(iter(self.queues.items()))
+        job = queue.popleft()
+        if queue:
+            self.queues.move_to_end(guild)
+        else:
+            del self.queues[guild]
+        return job
+
+    def finish(self, job, value=None, exception=None, result="ok"):
+        jobs = self.jobs.get(job.key, [])
+        if job in jobs:
+            jobs.remove(job)
+            if not jobs:
+                del self.jobs[job.key]
+        if job.future.done():
+            return
+        if exception:
+            job.future.set_exception(exception)
+        else:
+            job.future.set_result(value)
+        metrics.OCR_JOBS.inc(result=result)
+
+    async def spawn(self):
+        loop = asyncio.get_running_loop()
+        backoff = 1
+        while True:
+            worker = None
+            try:
+                worker = await loop.run_in_executor(None, Worker, self.lang, self.options)
+                kind, worker.engine = await loop.run_in_executor(None, worker.receive, 60)
+                log.info("Started OCR worker %d using %s", worker.pid, worker.engine)
+                return worker
+            except asyncio.CancelledError:
+                # Not waited for, since whoever cancelled us won't want to wait for it either
+                if worker:
+                    loop.run_in_executor(None, worker.retire)
+                raise
+            except Exception:
+                log.exception("Unable to start an OCR worker, retrying in %ds", backoff)
+                if worker:
+                    await loop.run_in_executor(None, worker.retire)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff*2, 300)
+
+    async def replace(self, worker, reason):
+        log.info("Replacing OCR worker %d: %s", worker.pid, reason)
+        metrics.OCR_WORKERS_REPLACED.inc(reason=reason)
+        await asyncio.get_running_loop().run_in_executor(None, worker.retire)
+        return await self.spawn()
+
+    async def healthy(self, worker):
+        try:
+            kind, engine = await asyncio.get_running_loop().run_in_executor(None, worker.call, ("ping",), 10)
+            return kind == "pong"
+        except Exception:
+            return False
+
+    async def work(self):
+        loop = asyncio.get_running_loop()
+        worker = await self.spawn()
+        try:
+            while True:
+                job = self.next_job()
+                if job is None:
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), self.health_interval)
+                    except asyncio.TimeoutError:
+                        if not await self.healthy(worker):
+                            worker = await self.replace(worker, "health")
+                    continue
+
+                worker = await self.run(job, worker)
+                if worker.jobs >= self.max_jobs:
+                    worker = await self.replace(worker, "max_jobs")
+        finally:
+            # Not waited for, so a cancelled scheduler gives up straight away
+            loop.run_in_executor(None, worker.retire)
+
+    async def run(self, job, worker):
+        """
+        Runs job on worker. Returns the worker to use for the next job, which is a fresh one if anything went wrong.
+        """
+        loop = asyncio.get_running_loop()
+        self.running.add(job)
+        job.worker = worker
+        worker.jobs += 1
+        start = time.monotonic()
+        try:
+            kind, value = await loop.run_in_executor(None, worker.call, job.request, self.timeout)
+            if kind != "error":
+                self.finish(job, (kind, value))
+            else:
+                log.error("OCR job %s failed: %s", job.key, value)
+                self.finish(job, exception=OcrError(value), result="error")
+        except JobTimeout:
+            log.warning("OCR job %s timed out after %.1fs", job.key, time.monotonic() - start)
+            self.finish(job, exception=JobTimeout("Gave up reading the image after %ss" % self.timeout), result="timeout")
+            worker = await self.replace(worker, "timeout")
+        except (EOFError, OSError):
+            if job.future.done():
+                worker = await self.replace(worker, "cancelled")
+            else:
+                log.error("OCR worker %d died reading job %s", worker.pid, job.key)
+                self.finish(job, exception=OcrError("The OCR worker crashed"), result="error")
+                worker = await self.replace(worker, "crashed")
+        finally:
+            self.running.discard(job)
+            job.worker = None
+            metrics.OCR_SECONDS.observe(time.monotonic() - start)
+            metrics.OCR_WAIT.observe(start - job.submitted)
+
+        # The job might have been cancelled just as it finished
+        if not worker.alive():
+            worker = await self.replace(worker, "cancelled")
+        return worker
@@ -0,0 +1,215 @@
+import io
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+from urllib.parse import urlsplit, urlunsplit
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR = "cache/"
+SCHEMA_VERSION = 3
+
+# How many bits two perceptual hashes can differ by and still count as the same image. Looking hashes up
+# by four bands only finds everything within 3 bits, since 4 differing bits can land one in each band
+MAX_DISTANCE = 3
+# How many of the 1024 bits of two detailed hashes can differ for a match to be trusted. Copies of the same
+# page of text differ in about 3% of them, different pages laid out the same way in more like 25%
+MAX_DETAIL_DISTANCE = 80
+# How far apart the shapes of two images can be, as a fraction of their aspect ratios
+MAX_ASPECT_DIFFERENCE = 0.02
+
+def dhash(picture, size):
+    from PIL import Image
+
+    pixels = list(picture.resize((size+1, size), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(size):
+        for column in range(size):
+            value = value << 1 | (pixels[row*(size+1) + column] > pixels[row*(size+1) + column + 1])
+    return value
+
+def fingerprint(image):
+    """
+    Perceptual hashes of the image, which survive resizing and re-encoding: a coarse 8x8 one to look
+    candidates up by, and a 32x32 one to check them against, since an 8x8 hash of a page of text can't
+    tell it from any other. Returns (hash, (width, height), detail), or None if PIL isn't around.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+
+    picture = Image.open(io.BytesIO(image))
+    size = picture.size
+    # Lets JPEGs decode at a fraction of their size, since we only need small thumbnails
+    picture.draft("L", (128, 128))
+    picture = picture.convert("L")
+    value = dhash(picture, 8)
+    # Stored as a signed 64 bit integer, since that's what SQLite has
+    phash = value - (1 << 64) if value >= 1 << 63 else value
+    return phash, size, dhash(picture, 32).to_bytes(128, "big")
+
+def similar(size, detail, other_size, other_detail):
+    aspect, other_aspect = size[0]/size[1], other_size[0]/other_size[1]
+    if abs(aspect - other_aspect) > MAX_ASPECT_DIFFERENCE * max(aspect, other_aspect):
+        return False
+    return bin(int.from_bytes(detail, "big") ^ int.from_bytes(other_detail, "big")).count("1") <= MAX_DETAIL_DISTANCE
+
+DISCORD_CDN = ("cdn.discordapp.com", "media.discordapp.net")
+
+def bands(phash):
+    """
+    The hash split into four 16 bit bands. Any hash within 3 bits of another shares at least one band with it.
+    """
+    value = phash & (1 << 64) - 1
+    return [value >> shift & 0xFFFF for shift in (48, 32, 16, 0)]
+
+def distance(a, b):
+    return bin((a ^ b) & (1 << 64) - 1).count("1")
+
+def normalize_url(url):
+    # Discord's CDN adds expiry parameters to attachment URLs, which change without the file changing
+    parts = urlsplit(url)
+    if parts.hostname not in DISCORD_CDN:
+        return url
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, "", ""))
+
+class OcrCache:
+    """
+    Remembers what OCR made of each image, by a hash of its contents and the languages it was read in.
+
+    Also remembers which URL gave which image, so reading the same attachment again doesn't even need it
+    downloaded, and optionally a perceptual hash of each image, so re-encoded or resized copies of it are
+    recognised too. Holds at most max_entries results, dropping the least recently used.
+    """
+    def __init__(self, path=CACHE_DIR + "ocr.sqlite3", max_entries=5000, perceptual=True):
+        self.max_entries = max_entries
+        self.perceptual = perceptual
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            # It's only a cache, so anything from an older layout can just go
+            self.db.executescript("DROP TABLE IF EXISTS results; DROP TABLE IF EXISTS urls;")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS results (
+                digest TEXT, lang TEXT, phash INTEGER, band0 INTEGER, band1 INTEGER, band2 INTEGER, band3 INTEGER,
+                width INTEGER, height INTEGER, detail BLOB, text TEXT, used REAL, PRIMARY KEY (digest, lang)
+            );
+            CREATE INDEX IF NOT EXISTS results_band0 ON results (band0);
+            CREATE INDEX IF NOT EXISTS results_band1 ON results (band1);
+            CREATE INDEX IF NOT EXISTS results_band2 ON results (band2);
+            CREATE INDEX IF NOT EXISTS results_band3 ON results (band3);
+            CREATE INDEX IF NOT EXISTS results_used ON results (used);
+            CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, digest TEXT);
+        """)
+        self.db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def hit(self, digest, lang, kind):
+        self.db.execute("UPDATE results SET used = ? WHERE digest = ? AND lang = ?", (time.time(), digest, lang))
+        metrics.CACHE_REQUESTS.inc(cache="ocr", result=kind)
+
+    def get_url(self, url, lang):
+        """
+        The text in the image at url, if we've read it before.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT results.digest, results.text FROM urls JOIN results ON urls.digest = results.digest WHERE urls.url = ? AND results.lang = ?",
+                (normalize_url(url), lang)
+            ).fetchone()
+            if row:
+                self.hit(row[0], lang, "hit")
+                return row[1]
+        return None
+
+    def get(self, image, lang):
+        """
+        Looks image up by its contents. Returns the text if it's been read before, and the key to store it under if not.
+        """
+        digest = hashlib.sha256(image).hexdigest()
+        with self.lock:
+            row = self.db.execute("SELECT text FROM results WHERE digest = ? AND lang = ?", (digest, lang)).fetchone()
+            if row:
+                self.hit(digest, lang, "hit")
+                return row[0], (digest, None)
+
+        prints = None
+        if self.perceptual:
+            try:
+                prints = fingerprint(image)
+            except Exception as e:
+                log.warning("Unable to work out a perceptual hash for an image: %s", e)
+
+        if prints is not None:
+            phash, size, detail = prints
+            with self.lock:
+                candidates = self.db.execute(
+                    "SELECT digest, text, phash, width, height, detail FROM results WHERE lang = ? AND (band0 = ? OR band1 = ? OR band2 = ? OR band3 = ?)",
+                    [lang] + bands(phash)
+                ).fetchall()
+                matches = sorted(
+                    (distance(phash, other), digest, text) for digest, text, other, width, height, other_detail in candidates
+                    if distance(phash, other) <= MAX_DISTANCE and similar(size, detail, (width, height), other_detail)
+                )
+                if matches:
+                    match, text = matches[0][1], matches[0][2]
+                    self.hit(match, lang, "hit_perceptual")
+                    # So this copy's found straight away next time
+                    self.insert(digest, lang, prints, text)
+                    return text, (digest, prints)
+
+        metrics.CACHE_REQUESTS.inc(cache="ocr", result="miss")
+        return None, (digest, prints)
+
+    def put(self, url, key, lang, text):
+        digest, prints = key
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self.insert(digest, lang, prints, text)
+                if url:
+                    self.db.execute("INSERT OR REPLACE INTO urls VALUES (?, ?)", (normalize_url(url), digest))
+                self.evict()
+                self.db.execute("COMMIT")
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def insert(self, digest, lang, prints, text):
+        if prints is not None:
+            phash, (width, height), detail = prints
+            row = [phash] + bands(phash) + [width, height, detail]
+        else:
+            row = [None]*8
+        self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [digest, lang] + row + [text, time.time()])
+
+    def remember_url(self, url, key):
+        """
+        Links url to an image we already had a result for, found under another URL.
+        """
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO urls VALUES (?, ?)", (normalize_url(url), key[0]))
+
+    def evict(self):
+        count = self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        # Clear out a bit extra, so this isn't needed on every single insert
+        excess = count - self.max_entries + self.max_entries//10
+        self.db.execute("DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY used LIMIT ?)", (excess,))
+        self.db.execute("DELETE FROM urls WHERE digest NOT IN (SELECT digest FROM results)")
+        log.info("Evicted %d OCR results from the cache", excess)
@@ -0,0 +1,15 @@
+#!/usr/bin/python3
+"""
+The entry point of an OCR worker process, started by ocr.Worker with the file descriptor of its end of a
+socket pair. Kept apart from bot.py so a worker only imports what it needs to read images.
+"""
+import sys
+
+from multiprocessing.connection import Connection
+
+import ocr
+
+if __name__ == "__main__":
+    connection = Connection(int(sys.argv[1]))
+    lang, options = connection.recv()
+    ocr.serve(connection, lang, options)
@@ -0,0 +1,260 @@
+"""
+Exact outcome distributions for dice expressions, so odds can be worked out instead of rolled for.
+"""
+import math
+import threading
+
+from collections import OrderedDict
+from functools import wraps
+
+import dice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Most outcomes a distribution can have
+MAX_OUTCOMES = 1000000
+# Convolutions bigger than this (the product of the two lengths) go through an FFT
+FFT_THRESHOLD = 250000
+# Most multiplications a single step can take without numpy, or with it
+MAX_WORK = 20000000
+MAX_WORK_VECTORIZED = 500000000
+# Most outcomes kept across all of a function's cached distributions
+MAX_CACHED = 4000000
+# Most pairs of outcomes multiplied at once in a product, so big ones don't need huge arrays
+PRODUCT_CHUNK = 1000000
+
+class TooComplex(dice.DiceError):
+    pass
+
+class Distribution:
+    """
+    The chance of each outcome from offset up: probabilities[i] is the chance of exactly offset+i.
+    """
+    def __init__(self, offset, probabilities):
+        self.offset = offset
+        self.probabilities = probabilities
+
+    def __len__(self):
+        return len(self.probabilities)
+
+    @property
+    def lowest(self):
+        return self.offset
+
+    @property
+    def highest(self):
+        return self.offset + len(self) - 1
+
+    def outcomes(self):
+        return zip(range(self.offset, self.offset + len(self)), self.listed())
+
+    def listed(self):
+        return self.probabilities.tolist() if numpy is not None else self.probabilities
+
+    def mean(self):
+        return sum(value*chance for value, chance in self.outcomes())
+
+    def variance(self):
+        mean = self.mean()
+        return sum((value-mean)**2 * chance for value, chance in self.outcomes())
+
+    def at_least(self, value):
+        return sum(self.listed()[max(0, value - self.offset):])
+
+    def at_most(self, value):
+        return sum(self.listed()[:max(0, value - self.offset + 1)])
+
+    def exactly(self, value):
+        return self.listed()[value - self.offset] if self.lowest <= value <= self.highest else 0.0
+
+def array(values):
+    return numpy.array(values, dtype=float) if numpy is not None else list(values)
+
+def check(outcomes, work, limit=None):
+    if limit is None:
+        limit = MAX_WORK_VECTORIZED if numpy is not None else MAX_WORK
+    if outcomes > MAX_OUTCOMES or work > limit:
+        raise TooComplex("That's too complicated to work out exactly")
+
+def cached(function):
+    """
+    Like lru_cache, but bounded by the total number of outcomes held instead of the number of results,
+    dropping the least recently used until they fit.
+    """
+    results = OrderedDict()
+    held = 0
+    lock = threading.Lock()
+
+    @wraps(function)
+    def wrapper(*args):
+        nonlocal held
+        with lock:
+            if args in results:
+                results.move_to_end(args)
+                return results[args]
+        result = function(*args)
+        with lock:
+            if args not in results:
+                results[args] = result
+                held += len(result)
+                while held > MAX_CACHED:
+                    held -= len(results.popitem(last=False)[1])
+        return result
+
+    def cache_clear():
+        nonlocal held
+        with lock:
+            results.clear()
+            held = 0
+
+    wrapper.cache_clear = cache_clear
+    return wrapper
+
+def convolve(a, b):
+    """
+    The distribution of the sum of two independent outcomes, as probability arrays.
+    """
+    check(len(a) + len(b) - 1, 0 if numpy is not None and len(a)*len(b) > FFT_THRESHOLD else len(a)*len(b))
+    if numpy is None:
+        out = [0.0] * (len(a) + len(b) - 1)
+        for i, x in enumerate(a):
+            if x:
+                for j, y in enumerate(b):
+                    out[i+j] += x*y
+        return out
+
+    if len(a)*len(b) <= FFT_THRESHOLD:
+        return numpy.convolve(a, b)
+    size = len(a) + len(b) - 1
+    out = numpy.fft.irfft(numpy.fft.rfft(a, size) * numpy.fft.rfft(b, size), size)
+    # Rounding leaves tiny negative chances where there should be none
+    return numpy.clip(out, 0, None)
+
+def binomial(count, chance):
+    """
+    The chance of each number of successes from count tries.
+    """
+    if chance >= 1:
+        return [0.0]*count + [1.0]
+    log_chance, log_miss = math.log(chance), math.log1p(-chance)
+    return [
+        math.exp(math.lgamma(count+1) - math.lgamma(hits+1) - math.lgamma(count-hits+1) + hits*log_chance + (count-hits)*log_miss)
+        for hits in range(count+1)
+    ]
+
+@cached
+def pool(count, sides):
+    """
+    The sum of count dice, built up by doubling so it takes about log(count) convolutions.
+    """
+    if count == 0:
+        return Distribution(0, array([1.0]))
+    if count == 1:
+        check(sides, 0)
+        return Distribution(1, array([1/sides]*sides))
+    half = pool(count//2, sides)
+    rest = pool(count - count//2, sides)
+    return Distribution(half.offset + rest.offset, convolve(half.probabilities, rest.probabilities))
+
+def kept(count, sides, low, high):
+    """
+    The sum of count dice, without the lowest low and highest high of them.
+
+    Goes through the faces from highest to lowest, deciding how many dice show each one. With i dice
+    already given higher faces, the rest are all at most this face, so each of them shows it with chance
+    1/face; and the ones showing it take up places i onwards when the dice are sorted, which says how many
+    of them are kept.
+    """
+    keep = count - low - high
+    length = keep*sides + 1
+    check(length, sides * count*(count+1)//2 * length)
+
+    def add(target, source, shift, chance):
+        if numpy is not None:
+            target[shift:] += chance * source[:length-shift]
+        else:
+            for i in range(length-shift):
+                target[shift+i] += chance * source[i]
+
+    # Sorted places i to count-1 are still to be filled; states[i] is the chance of each kept total so far
+    states = {0: array([1.0] + [0.0]*(length-1))}
+    for face in range(sides, 0, -1):
+        new = {}
+        for placed, totals in states.items():
+            for showing, chance in enumerate(binomial(count - placed, 1/face)):
+                if chance < 1e-300:
+                    continue
+                keeping = max(0, min(placed + showing, high + keep) - max(placed, high))
+                target = new.get(placed + showing)
+                if target is None:
+                    target = new[placed + showing] = array([0.0]*length)
+                add(target, totals, face*keeping, chance)
+        states = new
+
+    totals = states[count]
+    # No kept total can be less than one per die
+    return Distribution(keep, totals[keep:])
+
+def product(a, b):
+    """
+    The distribution of the product of two independent outcomes. Every pair of outcomes has to be
+    multiplied out, so this is capped at MAX_WORK pairs even with numpy.
+    """
+    corners = [x*y for x in (a.lowest, a.highest) for y in (b.lowest, b.highest)]
+    lowest, highest = min(corners), max(corners)
+    check(highest - lowest + 1, len(a)*len(b), MAX_WORK)
+
+    # numpy works in 64 bits, so huge static values have to be multiplied one by one
+    if numpy is None or max(abs(corner) for corner in corners) >= 2**62:
+        probabilities = [0.0]*(highest - lowest + 1)
+        for x, p in a.outcomes():
+            if p:
+                for y, q in b.outcomes():
+                    probabilities[x*y - lowest] += p*q
+        return Distribution(lowest, array(probabilities))
+
+    probabilities = numpy.zeros(highest - lowest + 1)
+    right = numpy.arange(b.lowest, b.highest + 1, dtype=numpy.int64)
+    step = max(1, PRODUCT_CHUNK // len(b))
+    for start in range(0, len(a), step):
+        left = numpy.arange(a.lowest + start, a.lowest + min(start + step, len(a)), dtype=numpy.int64)
+        values = numpy.multiply.outer(left, right) - lowest
+        chances = numpy.multiply.outer(a.probabilities[start:start+step], b.probabilities)
+        probabilities += numpy.bincount(values.ravel(), weights=chances.ravel(), minlength=len(probabilities))
+    return Distribution(lowest, probabilities)
+
+def combine(operator, a, b):
+    if operator == '+':
+        return Distribution(a.offset + b.offset, convolve(a.probabilities, b.probabilities))
+    if operator == '-':
+        return Distribution(a.offset - b.highest, convolve(a.probabilities, b.probabilities[::-1]))
+    return product(a, b)
+
+@cached
+def distribution(key):
+    """
+    The distribution of the expression with the given key (see dice.py). Cached by key, so parts that come
+    up again, in this expression or any other, aren't worked out twice.
+    """
+    kind = key[0]
+    if kind == "static":
+        return Distribution(key[1], array([1.0]))
+    if kind == "roll":
+        count, sides, low, high = key[1:]
+        if low or high:
+            return kept(count, sides, low, high)
+        return pool(count, sides)
+
+    result = distribution(key[1])
+    for operator, operand in key[2]:
+        result = combine(operator, result, distribution(operand))
+    return result
+
+def odds(string):
+    """
+    The distribution of each of the comma separated rolls in string.
+    """
+    return [distribution(expression.key) for expression in dice.compileRolls(string).expressions]
@@ -0,0 +1,126 @@
+import time
+import asyncio
+import logging
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+class PermissionResolver:
+    """
+    Answers the owner/dev/admin checks from memory.
+
+    The application's owner and team are fetched from Discord once, then kept fresh by a background task
+    every ttl seconds. Admin checks are memoized per (guild, user) for up to member_ttl seconds, and dropped
+    early whenever we hear about a change to that member's roles, or to the guild's roles.
+    """
+    def __init__(self, bot, ttl=300, member_ttl=60):
+        self.bot = bot
+        self.ttl = ttl
+        self.member_ttl = member_ttl
+
+        self.owner_id = None
+        self.dev_ids = frozenset()
+        self.fetched_at = None
+        self.fetching = None
+        self.refresher = None
+
+        self.admins = {}    # (guild id, user id) -> (is admin, time checked), oldest check first
+
+    def start(self):
+        if not self.refresher:
+            self.refresher = asyncio.get_running_loop().create_task(self.refresh_forever())
+
+    def stop(self):
+        if self.refresher:
+            self.refresher.cancel()
+            self.refresher = None
+
+    async def refresh_forever(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Unable to refresh application info, keeping what we had")
+            await asyncio.sleep(self.ttl)
+
+    async def refresh(self):
+        await asyncio.shield(self.fetch_in_background())
+
+    def fetch_in_background(self):
+        # Share a single request between everyone who asks while one's already in flight
+        if not self.fetching:
+            self.fetching = asyncio.get_running_loop().create_task(self.fetch())
+            self.fetching.add_done_callback(self.fetched)
+        return self.fetching
+
+    def fetched(self, task):
+        self.fetching = None
+        if not task.cancelled() and task.exception():
+            log.error("Unable to fetch application info: %s", task.exception())
+
+    async def fetch(self):
+        appInfo = await self.bot.application_info()
+        if appInfo.team is None:
+            self.owner_id = appInfo.owner.id
+            self.dev_ids = frozenset()
+        else:
+            self.owner_id = appInfo.team.owner.id
+            self.dev_ids = frozenset(member.id for member in appInfo.team.members)
+        self.fetched_at = time.monotonic()
+        log.info("Refreshed application info: owner %s, %d dev(s)", self.owner_id, len(self.dev_ids))
+
+    async def application(self):
+        if self.fetched_at is None:
+            metrics.CACHE_REQUESTS.inc(cache="application", result="miss")
+            await self.refresh()
+        else:
+            metrics.CACHE_REQUESTS.inc(cache="application", result="hit")
+            if time.monotonic() - self.fetched_at > 2*self.ttl:
+                # The background refresh has fallen behind; kick one off, but don't wait on it
+                self.fetch_in_background()
+
+    async def is_owner(self, user):
+        await self.application()
+        return user.id == self.owner_id
+
+    async def is_dev(self, user):
+        await self.application()
+        return user.id in self.dev_ids or user.id == self.owner_id
+
+    async def is_admin(self, message):
+        if message.guild:
+            key = (message.guild.id, message.author.id)
+            cached = self.admins.get(key)
+            if cached and time.monotonic() - cached[1] < self.member_ttl:
+                metrics.CACHE_REQUESTS.inc(cache="admin", result="hit")
+                if cached[0]:
+                    return True
+            else:
+                metrics.CACHE_REQUESTS.inc(cache="admin", result="miss")
+                admin = message.channel.permissions_for(message.author).administrator
+                now = time.monotonic()
+                self.prune(now)
+                # Moved to the end, to keep the oldest checks first
+                self.admins.pop(key, None)
+                self.admins[key] = (admin, now)
+                if admin:
+                    return True
+        return await self.is_dev(message.author)
+
+    def prune(self, now):
+        # Drops expired checks, so members who've left or gone quiet don't stay cached forever
+        while self.admins:
+            key, (admin, checked) = next(iter(self.admins.items()))
+            if now - checked < self.member_ttl:
+                break
+            del self.admins[key]
+
+    def invalidate_member(self, guild_id, user_id):
+        self.admins.pop((guild_id, user_id), None)
+
+    def invalidate_guild(self, guild_id):
+        for key in [key for key in self.admins if key[0] == guild_id]:
+            del self.admins[key]
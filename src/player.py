@@ -1,4 +1,3 @@
-import yt_dlp
 import re
 import discord
 import logging
@@ -9,6 +8,8 @@ import random
 import math
 import threading
 
+import metrics
+
 log = logging.getLogger(__name__)
 
 LINK_REGEX = re.compile('((http(s)*:[/][/]|www.)([a-z]|[A-Z]|[0-9]|[/.]|[~])*)')
@@ -86,10 +87,12 @@ class Player():
 
     async def download(self, info):
         log.info("Downloading `%s` for %s", info['title'], self.guild)
-        await self.loop.run_in_executor(None, self.bot.ytdl.download, [info['webpage_url'],])
+        with metrics.YTDL_DOWNLOAD.time():
+            await self.loop.run_in_executor(None, self.bot.ytdl.download, [info['webpage_url'],])
     
     async def retrieve_info(self, song_url): 
-        return await self.loop.run_in_executor(None, functools.partial(self.bot.ytdl.extract_info, song_url, download=False, process=True))
+        with metrics.YTDL_EXTRACT.time():
+            return await self.loop.run_in_executor(None, functools.partial(self.bot.ytdl.extract_info, song_url, download=False, process=True))
 
     def after_playing(self, error):
         log.info("Finished playing `%s` on %s", self.now_playing['title'], self.guild)
@@ -0,0 +1,160 @@
+"""
+Image cleanup and language detection for OCR. Runs inside the OCR worker processes.
+"""
+import io
+import re
+
+STOPWORDS = {
+    'eng': "the and of to is in that it you for with was on are this have not be at",
+    'spa': "el la de que y en los las del se por un una con para es no lo su al",
+    'fra': "le la les de des et est un une du que qui pas pour dans ce sur au je",
+    'fin': "ja on ei se että hän oli ovat mutta kun niin tämä myös kuin mitä ole",
+    'deu': "der die und das ist nicht ein eine zu den mit sich auf ich es dem",
+}
+STOPWORDS = {lang: frozenset(words.split()) for lang, words in STOPWORDS.items()}
+
+# Letters that give a language away on their own
+SPECIAL_LETTERS = {
+    'spa': "ñ¿¡",
+    'fra': "çœêèùâî",
+    'fin': "äöå",
+    'deu': "äöüß",
+}
+
+def load(image, max_side=2000, min_side=800):
+    """
+    Decodes image in greyscale, at a size Tesseract reads well. Large JPEGs are decoded straight
+    to a reduced size, rather than decoded in full and then shrunk.
+
+    Only the shorter side is held to max_side, so long screenshots keep their text legible.
+    """
+    from PIL import Image
+
+    picture = Image.open(io.BytesIO(image))
+    width, height = picture.size
+    scale = min(1, max_side / min(width, height))
+    if picture.format == "JPEG" and scale < 1:
+        picture.draft("L", (int(width*scale), int(height*scale)))
+
+    if picture.mode in ("RGBA", "LA") or (picture.mode == "P" and "transparency" in picture.info):
+        # Transparency would otherwise come out black, which is usually the colour of the text
+        picture = picture.convert("RGBA")
+        background = Image.new("RGBA", picture.size, "white")
+        background.alpha_composite(picture)
+        picture = background
+    picture = picture.convert("L")
+
+    width, height = picture.size
+    if min(width, height) > max_side:
+        scale = max_side / min(width, height)
+        picture = picture.resize((round(width*scale), round(height*scale)), Image.LANCZOS)
+    elif max(width, height) < min_side:
+        # Small text reads better blown up a bit
+        picture = picture.resize((width*2, height*2), Image.BICUBIC)
+    return picture
+
+def otsu_threshold(histogram):
+    """
+    The grey level that best splits the histogram into two classes.
+    """
+    total = sum(histogram)
+    sum_all = sum(level*count for level, count in enumerate(histogram))
+    weight_below = sum_below = 0
+    best, threshold = 0, 127
+    for level, count in enumerate(histogram):
+        weight_below += count
+        if not weight_below:
+            continue
+        weight_above = total - weight_below
+        if not weight_above:
+            break
+        sum_below += level*count
+        between = weight_below * weight_above * (sum_below/weight_below - (sum_all-sum_below)/weight_above)**2
+        if between > best:
+            best, threshold = between, level
+    return threshold
+
+def binarize(picture):
+    """
+    Black text on a white background, whichever way round it started (so dark mode screenshots too).
+    """
+    histogram = picture.histogram()
+    threshold = otsu_threshold(histogram)
+    dark_background = sum(histogram[:threshold+1]) > sum(histogram)/2
+    if dark_background:
+        table = [255 if level <= threshold else 0 for level in range(256)]
+    else:
+        table = [0 if level <= threshold else 255 for level in range(256)]
+    return picture.point(table)
+
+def skew_angle(picture, limit=10):
+    """
+    The rotation, in degrees, that best lines the text up horizontally. Found by trying angles on a thumbnail,
+    and picking the one where the rows are most distinct: all ink or all background.
+    """
+    from PIL import Image
+
+    small = picture.copy()
+    small.thumbnail((400, 400))
+
+    def score(angle):
+        rotated = small.rotate(angle, resample=Image.BILINEAR, fillcolor=255)
+        rows = list(rotated.resize((1, rotated.height), Image.BOX).getdata())
+        mean = sum(rows)/len(rows)
+        return sum((row-mean)**2 for row in rows)
+
+    best = max(range(-limit, limit+1), key=score)
+    return max((best + step/4 for step in range(-4, 5)), key=score)
+
+def clean(picture, threshold=True, deskew=True):
+    from PIL import Image
+
+    if threshold:
+        picture = binarize(picture)
+    if deskew:
+        angle = skew_angle(picture)
+        if abs(angle) >= 0.5:
+            picture = picture.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+    return picture
+
+def bands(picture, height):
+    """
+    Splits picture into horizontal bands of about height pixels, cutting through gaps between lines of
+    text where there are any. Returns (top, bottom) pairs.
+    """
+    from PIL import Image
+
+    # How much ink is in each row, from the average of the row: 255 is blank
+    rows = list(picture.resize((1, picture.height), Image.BOX).getdata())
+
+    out = []
+    top = 0
+    while picture.height - top > height*1.5:
+        # Cut at the emptiest row near where the band would end, preferring the closest to it
+        window = range(top + height//2, min(top + height*3//2, picture.height))
+        target = top + height
+        cut = max(window, key=lambda row: (rows[row], -abs(row - target)))
+        out.append((top, cut))
+        top = cut
+    out.append((top, picture.height))
+    return out
+
+def detect_language(text, languages):
+    """
+    Which of languages text is most likely to be in, judging by common words and telltale letters.
+    Falls back to the first language if there's nothing to go on.
+    """
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        return languages[0]
+
+    scores = {}
+    for lang in languages:
+        stopwords = STOPWORDS.get(lang, ())
+        scores[lang] = sum(word in stopwords for word in words) + 2*sum(text.count(letter) for letter in SPECIAL_LETTERS.get(lang, ""))
+
+    best = max(languages, key=lambda lang: scores[lang])
+    # Needs to clearly beat the first language, since the first pass was done in it and will be biased towards it
+    if scores[best] < max(2, 0.05*len(words)) or scores[best] <= scores[languages[0]]*1.2:
+        return languages[0]
+    return best
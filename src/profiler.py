@@ -0,0 +1,111 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+
+from collections import Counter
+
+log = logging.getLogger(__name__)
+
+class SamplingProfiler:
+    """
+    A sampling profiler that periodically snapshots the stack of every other thread in the process.
+    Sampling only touches the interpreter from its own thread, so the overhead on the threads being
+    profiled is little more than contention for the GIL.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()     # (thread name, frames from root to leaf) -> samples
+        self.samples = 0
+        self.duration = 0
+
+    @staticmethod
+    def describe(code):
+        return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def sample(self, own_thread, names):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self.describe(frame.f_code))
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[(names.get(thread_id, str(thread_id)), tuple(stack))] += 1
+        self.samples += 1
+
+    def run(self, seconds):
+        own_thread = threading.get_ident()
+        start = time.perf_counter()
+        end = start + seconds
+        while time.perf_counter() < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            self.sample(own_thread, names)
+            time.sleep(self.interval)
+        self.duration = time.perf_counter() - start
+        return self
+
+    def top(self, count=25):
+        """
+        Table of the functions seen most often, both at the top of the stack (self) and anywhere in it (total).
+        Threads sitting idle in a wait show up too, so expect lock and select calls near the top.
+
+        Each round samples every thread, so percentages are of all the stacks sampled, across threads.
+        """
+        own = Counter()
+        total = Counter()
+        for (thread, stack), samples in self.stacks.items():
+            if stack:
+                own[stack[-1]] += samples
+            for function in set(stack):
+                total[function] += samples
+
+        stacks = max(sum(self.stacks.values()), 1)
+        lines = ["%d stacks from %d samples over %.1fs" % (stacks, self.samples, self.duration), "%8s %8s  %s" % ("self%", "total%", "function")]
+        for function, samples in total.most_common(count):
+            lines.append("%7.1f%% %7.1f%%  %s" % (100*own[function]/stacks, 100*samples/stacks, function))
+        return "\n".join(lines)
+
+    def collapsed(self):
+        """
+        Stacks in the collapsed format used by flamegraph.pl and speedscope, one per line, rooted at the thread name.
+        """
+        return "\n".join(
+            "%s;%s %d" % (thread.replace(";", ":"), ";".join(stack), samples)
+            for (thread, stack), samples in sorted(self.stacks.items())
+        ) + "\n"
+
+running = threading.Lock()
+
+async def profile(seconds, interval=0.005):
+    """
+    Profile for the given number of seconds on a dedicated thread, so as not to take up an executor slot.
+    Raises RuntimeError if a profile is already running.
+    """
+    if not running.acquire(blocking=False):
+        raise RuntimeError("A profile is already running")
+
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+
+    def finish(result, error):
+        if done.cancelled():
+            return
+        if error:
+            done.set_exception(error)
+        else:
+            done.set_result(result)
+
+    def target():
+        try:
+            loop.call_soon_threadsafe(finish, SamplingProfiler(interval).run(seconds), None)
+        except Exception as e:
+            loop.call_soon_threadsafe(finish, None, e)
+        finally:
+            running.release()
+
+    threading.Thread(target=target, name="profiler", daemon=True).start()
+    return await done
@@ -0,0 +1,91 @@
+from collections import OrderedDict, deque
+
+import metrics
+
+def image_url(message):
+    """
+    The URL of the first image in message, whether it's attached or embedded, or None.
+    """
+    if message.attachments:
+        return message.attachments[0].url
+    for embed in message.embeds:
+        if embed.image and embed.image.url:
+            return embed.image.url
+        if embed.thumbnail and embed.thumbnail.url:
+            return embed.thumbnail.url
+    return None
+
+class Seen:
+    """
+    What we keep of a message: enough to quote it or find its image.
+    """
+    __slots__ = ("id", "author", "content", "image_url")
+
+    def __init__(self, message):
+        self.id = message.id
+        self.author = message.author
+        self.content = message.content
+        self.image_url = image_url(message)
+
+class RecentMessages:
+    """
+    The last few messages in each channel, as they come in, so commands that look back through a channel
+    can usually do it without asking Discord.
+
+    Only knows about messages sent since the bot started, so callers should fall back to the channel's
+    history when it can't give them an answer.
+    """
+    def __init__(self, per_channel=50, channels=1000):
+        self.per_channel = per_channel
+        self.channels = channels
+        self.messages = OrderedDict()   # channel id -> deque of Seen, oldest first; channels in least recently used order
+
+    def add(self, message):
+        channel = self.messages.get(message.channel.id)
+        if channel is None:
+            channel = self.messages[message.channel.id] = deque(maxlen=self.per_channel)
+            if len(self.messages) > self.channels:
+                self.messages.popitem(last=False)
+        else:
+            self.messages.move_to_end(message.channel.id)
+        channel.append(Seen(message))
+
+    def update(self, message):
+        # Mostly for link previews, which Discord adds to a message after it's been sent
+        for number, seen in enumerate(self.messages.get(message.channel.id, ())):
+            if seen.id == message.id:
+                self.messages[message.channel.id][number] = Seen(message)
+                return
+
+    def remove(self, channel_id, message_ids):
+        channel = self.messages.get(channel_id)
+        if channel:
+            kept = [seen for seen in channel if seen.id not in message_ids]
+            channel.clear()
+            channel.extend(kept)
+
+    def get(self, channel_id, message_id):
+        seen = next((seen for seen in self.messages.get(channel_id, ()) if seen.id == message_id), None)
+        metrics.CACHE_REQUESTS.inc(cache="recent_messages", result="hit" if seen else "miss")
+        return seen
+
+    def find(self, channel_id, before, predicate=lambda seen: True, limit=None):
+        """
+        The newest message before the message with id before that matches predicate, looking back at most
+        limit messages. Returns (message, certain), where certain is whether a None can be trusted, which
+        it can only be if we've seen all of the messages it had to look through.
+        """
+        looked = 0
+        for seen in reversed(self.messages.get(channel_id, ())):
+            if seen.id >= before:
+                continue
+            if limit is not None and looked >= limit:
+                break
+            looked += 1
+            if predicate(seen):
+                metrics.CACHE_REQUESTS.inc(cache="recent_messages", result="hit")
+                return seen, True
+
+        certain = limit is not None and looked >= limit
+        metrics.CACHE_REQUESTS.inc(cache="recent_messages", result="hit" if certain else "miss")
+        return None, certain
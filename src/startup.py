@@ -0,0 +1,96 @@
+"""
+Startup profiling, enabled with --profile-startup.
+
+Times every module import, splitting each into time spent in the module itself and time spent in
+the modules it pulled in, along with named phases of initialisation. Only uses the standard library,
+and has to be enabled before anything else is imported for the import times to be complete.
+"""
+import os
+import sys
+import time
+import logging
+import builtins
+import threading
+
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+enabled = False
+started = time.perf_counter()
+
+imports = []    # (depth, name, self time, cumulative time), in the order they finished
+phases = []     # (name, seconds)
+stack = []      # time spent in nested imports, for each import in progress
+
+original_import = builtins.__import__
+main_thread = threading.get_ident()
+
+def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    # Only the main thread is timed, so there's just the one stack of imports in progress
+    if level or name in sys.modules or threading.get_ident() != main_thread:
+        return original_import(name, globals, locals, fromlist, level)
+
+    stack.append(0)
+    start = time.perf_counter()
+    try:
+        return original_import(name, globals, locals, fromlist, level)
+    finally:
+        cumulative = time.perf_counter() - start
+        nested = stack.pop()
+        if stack:
+            stack[-1] += cumulative
+        imports.append((len(stack), name, cumulative - nested, cumulative))
+
+def enable(on=True):
+    global enabled
+    if on and not enabled:
+        enabled = True
+        builtins.__import__ = timed_import
+
+def disable():
+    global enabled
+    enabled = False
+    builtins.__import__ = original_import
+
+@contextmanager
+def phase(name):
+    """
+    Times a named step of startup. Does nothing unless profiling is enabled.
+    """
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases.append((name, time.perf_counter() - start))
+
+def mark(name):
+    """
+    Records a point in startup, timed from when this module was first imported.
+    """
+    if enabled:
+        phases.append((name, time.perf_counter() - started))
+
+def report(count=40):
+    lines = ["Startup profile", "===============", "", "Phases:"]
+    for name, seconds in phases:
+        lines.append("  %-36s %9.1fms" % (name, seconds*1000))
+
+    lines += ["", "Slowest imports (self time, cumulative time, module):"]
+    for depth, name, own, cumulative in sorted(imports, key=lambda entry: -entry[3])[:count]:
+        lines.append("  %9.1fms %9.1fms  %s%s" % (own*1000, cumulative*1000, "  "*depth, name))
+
+    lines += ["", "Total import time: %.1fms over %d modules" % (sum(entry[2] for entry in imports)*1000, len(imports))]
+    return "\n".join(lines)
+
+def write_report(path="logs/startup.txt"):
+    if not enabled:
+        return
+    text = report()
+    disable()
+    with open(path, 'w') as f:
+        f.write(text + "\n")
+    log.info("%s\n\nWritten to %s", text, os.path.abspath(path))
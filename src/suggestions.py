@@ -1,39 +1,309 @@
-import trello
+import re
+import math
+import time
+import asyncio
 import logging
+import functools
+
+from collections import defaultdict
 
 log = logging.getLogger(__name__)
 
+class Suggestion:
+    def __init__(self, id, name, description, column, suggested_by="", suggested_on=""):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.column = column
+        self.suggested_by = suggested_by
+        self.suggested_on = suggested_on
+        self.saved_fields = set()
+        self.saved = False
+
+# How much more a word in a title counts than one in a description
+TITLE_WEIGHT = 2
+
+STOPWORDS = frozenset("a an and are be can could for from have i in is it its it's of on or so that the this to with would you".split())
+
+def features(text):
+    """
+    Words and word trigrams, so small differences in spelling or wording still match.
+    """
+    out = set()
+    for word in re.findall(r"[a-z0-9']+", text.lower()):
+        if word in STOPWORDS:
+            continue
+        out.add(word)
+        padded = " %s " % word
+        out.update(padded[i:i+3] for i in range(len(padded)-2))
+    return out
+
+def weighted(title, description=""):
+    """
+    The features of a title and description, and how much each counts for.
+    """
+    out = dict.fromkeys(features(description), 1)
+    out.update(dict.fromkeys(features(title), TITLE_WEIGHT))
+    return out
+
+class SuggestionIndex:
+    """
+    An inverted index over suggestion titles and descriptions, scored by IDF-weighted cosine similarity,
+    with words in titles counting for more.
+    """
+    def __init__(self, suggestions=()):
+        self.postings = defaultdict(set)    # feature -> {suggestion index}
+        self.suggestions = []
+        self.features = []  # [{feature: weight}]
+        self.norms = {}
+        for suggestion in suggestions:
+            self.add(suggestion)
+
+    def add(self, suggestion):
+        number = len(self.suggestions)
+        self.suggestions.append(suggestion)
+        self.features.append(weighted(suggestion.name, suggestion.description))
+        for feature in self.features[number]:
+            self.postings[feature].add(number)
+        # The weights have all shifted
+        self.norms = {}
+
+    def idf(self, feature):
+        return math.log(1 + len(self.suggestions)/(1 + len(self.postings.get(feature, ()))))
+
+    def norm(self, number):
+        # Worked out lazily, for just the suggestions that match something
+        if number not in self.norms:
+            self.norms[number] = math.sqrt(sum((self.idf(feature)*weight)**2 for feature, weight in self.features[number].items()))
+        return self.norms[number]
+
+    def search(self, text, limit=5, threshold=0.1, title=""):
+        """
+        Returns up to limit (score, suggestion) pairs, best first, scoring between 0 and 1.
+        Words in title count for more, like they do in the suggestions' own titles.
+        """
+        query = weighted(title, text)
+        if not query or not self.suggestions:
+            return []
+
+        scores = defaultdict(float)
+        query_norm = 0
+        for feature, query_weight in query.items():
+            idf = self.idf(feature)
+            query_norm += (idf*query_weight)**2
+            for number in self.postings.get(feature, ()):
+                scores[number] += idf*query_weight * idf*self.features[number][feature]
+
+        query_norm = math.sqrt(query_norm)
+        results = [(score/(query_norm*self.norm(number) or 1), number) for number, score in scores.items()]
+        results = sorted((score, number) for score, number in results if score >= threshold)[::-1][:limit]
+        return [(score, self.suggestions[number]) for score, number in results]
+
 class SuggestionList():
-    def __init__(self, api_key, api_secret, oauth_token, oauth_secret, new_card_list):
-        self.client = trello.TrelloClient(api_key, api_secret=api_secret, token=None, token_secret=None)
-        self.board = self.client.list_boards()[0]
-        self.new_card_list = self.board.get_list(new_card_list)
+    """
+    Keeps a snapshot of the suggestion board in memory, refreshed in the background, so reads never wait on Trello.
+
+    The whole board (lists, cards and their custom fields) is fetched in a single request.
+    New suggestions show up in the snapshot straight away, and are written to Trello by a background
+    worker that keeps retrying, with backoff, for as long as Trello is unavailable.
+
+    The client can be anything with py-trello's fetch_json(uri_path, http_method, query_params=..., post_args=...),
+    like faketrello.FakeTrelloClient.
+    """
+    def __init__(self, client, new_card_list, refresh_interval=300, max_backoff=300):
+        self.client = client
+        self.new_card_list = new_card_list
+        self.refresh_interval = refresh_interval
+        self.max_backoff = max_backoff
+
+        self.board_id = None
+        self.columns = []   # [(list id, name)], in board order
+        self.cards = []     # [Suggestion], in board order
+        self.fields = {}    # custom field name -> id
+        self.unconfirmed = []   # [Suggestion] we've added, but haven't seen on the board yet
+        self.index = SuggestionIndex()
+        self.refreshed_at = None
+
+        self.loaded = None
+        self.writes = None
+        self.tasks = []
+
+    @classmethod
+    def connect(cls, api_key, api_secret, new_card_list, **kwargs):
+        import trello
+        return cls(trello.TrelloClient(api_key, api_secret=api_secret, token=None, token_secret=None), new_card_list, **kwargs)
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self.loaded = asyncio.Event()
+        self.writes = asyncio.Queue()
+        self.tasks = [loop.create_task(self.refresh_forever()), loop.create_task(self.write_forever())]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    async def ready(self, timeout=10):
+        """
+        Waits for the first snapshot of the board. Returns whether there's one to read from.
+        """
+        try:
+            await asyncio.wait_for(self.loaded.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.refreshed_at is not None
+
+    ##################################################################
+    # Reading
+    ##################################################################
+
+    async def refresh_forever(self):
+        loop = asyncio.get_running_loop()
+        backoff = 1
+        while True:
+            try:
+                self.apply(*(await loop.run_in_executor(None, self.fetch)))
+                self.loaded.set()
+                backoff = 1
+                await asyncio.sleep(self.refresh_interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Unable to refresh suggestions from Trello, retrying in %ds: %s", backoff, e)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff*2, self.refresh_interval)
+
+    def fetch(self):
+        """
+        Fetches and parses the board. Safe to run off the event loop, since it doesn't touch the snapshot.
+        """
+        start = time.perf_counter()
+
+        if not self.board_id:
+            self.board_id = self.client.fetch_json('/members/me/boards', query_params={'fields': 'name'})[0]['id']
+
+        board = self.client.fetch_json('/boards/' + self.board_id, query_params={
+            'fields': 'name',
+            'lists': 'open',
+            'list_fields': 'name',
+            'cards': 'open',
+            'card_fields': 'name,desc,idList',
+            'card_customFieldItems': 'true',
+            'customFields': 'true',
+        })
+
+        fields = {field['name']: field['id'] for field in board.get('customFields', [])}
+        field_names = {id: name for name, id in fields.items()}
+        columns = [(column['id'], column['name']) for column in board.get('lists', [])]
+        column_names = dict(columns)
+
+        cards = []
+        for card in board.get('cards', []):
+            values = {}
+            for item in card.get('customFieldItems', []):
+                value = item.get('value') or {}
+                values[field_names.get(item['idCustomField'])] = next(iter(value.values()), "")
+            cards.append(Suggestion(
+                card['id'], card['name'], card['desc'], column_names.get(card['idList'], ""),
+                values.get("Suggested By", ""), values.get("Suggested On", "")
+            ))
+
+        log.info("Fetched %d suggestions from Trello in %.2fs", len(cards), time.perf_counter() - start)
+        return fields, columns, cards
+
+    def apply(self, fields, columns, cards):
+        # Anything we've added is shown as we know it until it's been fully saved and has shown up on the board
+        fetched = {card.id for card in cards}
+        self.unconfirmed = [suggestion for suggestion in self.unconfirmed if not (suggestion.saved and suggestion.id in fetched)]
+        pending = {suggestion.id for suggestion in self.unconfirmed}
+        # Suggestions added before the board had loaded didn't know what their column's called
+        new_column = dict(columns).get(self.new_card_list)
+        for suggestion in self.unconfirmed:
+            suggestion.column = new_column or suggestion.column
+
+        self.fields = fields
+        self.columns = columns
+        self.cards = [card for card in cards if card.id not in pending] + self.unconfirmed
+        self.index = SuggestionIndex(self.cards)
+        self.refreshed_at = time.time()
 
     def get_suggestions(self):
-        out = []
-        for column in self.board.list_lists():
-            for card in column.list_cards():
-                out.append(card)
-        return out
-    
+        return list(self.cards)
+
     def get_suggestion_categories(self):
-        out = {}
-        for column in self.board.list_lists():
-            col_out=[]
-            for card in column.list_cards():
-                col_out.append(card)
-            out[column.name]=col_out
+        out = {name: [] for id, name in self.columns}
+        for card in self.cards:
+            out.setdefault(card.column, []).append(card)
         return out
 
-    def add_suggestion(self, title, description, author):
-        card = self.new_card_list.add_card(title, desc=description)
-        for field in self.board.get_custom_field_definitions():
-            if field.name=="Suggested By":
-                card.set_custom_field(author, field)
-            elif field.name=="Suggested On":
-                card.set_custom_field(card.created_date.isoformat(), field)
+    def search(self, text, limit=5):
+        return self.index.search(text, limit)
 
+    def find_duplicates(self, title, description="", threshold=0.5):
+        """
+        Suggestions that look like the same idea. The title counts for more than the description.
+        """
+        return self.index.search(description, limit=3, threshold=threshold, title=title)
 
+    ##################################################################
+    # Writing
+    ##################################################################
+
+    def add_suggestion(self, title, description, author):
+        """
+        Adds the suggestion to the snapshot straight away, and queues it up to be written to Trello.
+        """
+        suggestion = Suggestion(
+            None, title, description, dict(self.columns).get(self.new_card_list, ""),
+            author, time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+        )
+        self.cards.append(suggestion)
+        self.unconfirmed.append(suggestion)
+        self.index.add(suggestion)
+        self.writes.put_nowait(suggestion)
+        return suggestion
 
+    async def write_forever(self):
+        # Custom field ids come from the board, so without them Suggested By and On would be skipped
+        await self.loaded.wait()
+        while True:
+            suggestion = await self.writes.get()
+            backoff = 1
+            while True:
+                try:
+                    await self.write(suggestion)
+                    break
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    log.warning("Unable to save suggestion `%s` to Trello, retrying in %ds: %s", suggestion.name, backoff, e)
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff*2, self.max_backoff)
 
+    async def write(self, suggestion):
+        """
+        Saves suggestion to Trello a request at a time. The requests run in the executor, but what each one did
+        is recorded back here on the event loop, where apply() can see it.
+        """
+        loop = asyncio.get_running_loop()
+        # Picks up where it left off if a retry comes after the card was created, so it isn't created twice
+        if suggestion.id is None:
+            card = await loop.run_in_executor(None, functools.partial(self.client.fetch_json, '/cards', http_method='POST', post_args={
+                'idList': self.new_card_list,
+                'name': suggestion.name,
+                'desc': suggestion.description,
+            }))
+            suggestion.id = card['id']
 
+        for name, value, kind in (("Suggested By", suggestion.suggested_by, 'text'), ("Suggested On", suggestion.suggested_on, 'date')):
+            if name in self.fields and name not in suggestion.saved_fields:
+                await loop.run_in_executor(None, functools.partial(
+                    self.client.fetch_json,
+                    '/cards/%s/customField/%s/item' % (suggestion.id, self.fields[name]),
+                    http_method='PUT',
+                    post_args={'value': {kind: value}}
+                ))
+                suggestion.saved_fields.add(name)
+        suggestion.saved = True
+        log.info("Saved suggestion `%s` to Trello", suggestion.name)
@@ -0,0 +1,71 @@
+"""
+Checks odds.py's distributions against every possible roll, with and without numpy.
+"""
+import itertools
+import unittest
+
+import odds
+
+def brute_force(count, sides, low=0, high=0):
+    out = {}
+    for roll in itertools.product(range(1, sides+1), repeat=count):
+        total = sum(sorted(roll)[low:count-high])
+        out[total] = out.get(total, 0) + 1
+    return {total: ways / sides**count for total, ways in out.items()}
+
+class OddsTest(unittest.TestCase):
+    ROLLS = [(4, 6, 1, 0), (4, 6, 1, 1), (3, 6, 0, 1), (5, 4, 2, 1), (2, 20, 1, 0), (3, 3, 3, 0), (1, 8, 0, 0), (6, 6, 0, 0), (0, 6, 0, 0)]
+
+    def assertMatches(self, distribution, expected):
+        self.assertAlmostEqual(sum(distribution.listed()), 1)
+        for total in range(min(expected) - 2, max(expected) + 3):
+            self.assertAlmostEqual(distribution.exactly(total), expected.get(total, 0.0), msg="total %d" % total)
+
+    def check_rolls(self):
+        for count, sides, low, high in self.ROLLS:
+            with self.subTest(count=count, sides=sides, low=low, high=high):
+                self.assertMatches(odds.distribution(("roll", count, sides, low, high)), brute_force(count, sides, low, high))
+
+    def check_operations(self):
+        d6 = brute_force(1, 6)
+        d4 = brute_force(1, 4)
+        self.assertMatches(odds.odds("1d6-1d4")[0], {
+            total: sum(p*q for a, p in d6.items() for b, q in d4.items() if a - b == total) for total in range(-3, 6)
+        })
+        self.assertMatches(odds.odds("1d6*1d4+2")[0], {
+            total: sum(p*q for a, p in d6.items() for b, q in d4.items() if a*b + 2 == total) for total in range(3, 27)
+        })
+        self.assertMatches(odds.odds("0d6+3")[0], {3: 1.0})
+
+    def test_with_numpy(self):
+        if odds.numpy is None:
+            self.skipTest("numpy isn't installed")
+        self.check_rolls()
+        self.check_operations()
+
+    def test_without_numpy(self):
+        numpy = odds.numpy
+        odds.numpy = None
+        odds.pool.cache_clear()
+        odds.distribution.cache_clear()
+        try:
+            self.check_rolls()
+            self.check_operations()
+        finally:
+            odds.numpy = numpy
+            odds.pool.cache_clear()
+            odds.distribution.cache_clear()
+
+    def test_statistics(self):
+        distribution = odds.odds("4d6dl1+2")[0]
+        expected = {total + 2: chance for total, chance in brute_force(4, 6, 1).items()}
+        self.assertAlmostEqual(distribution.mean(), sum(total*chance for total, chance in expected.items()))
+        self.assertAlmostEqual(distribution.at_least(15), sum(chance for total, chance in expected.items() if total >= 15))
+
+    def test_too_complex(self):
+        for string in ("1d30000000", "1d20000*1d20000", "1d2000000+1d2000000"):
+            with self.subTest(string=string):
+                self.assertRaises(odds.TooComplex, odds.odds, string)
+
+if __name__ == "__main__":
+    unittest.main()